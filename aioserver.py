@@ -0,0 +1,9 @@
+import os
+
+from aiohttp import web
+from mrtallyman.aioserver import create_aio_app
+
+app = create_aio_app()
+
+if __name__ == '__main__':
+    web.run_app(app, port=int(os.environ.get('PORT', 5000)))
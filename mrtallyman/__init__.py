@@ -2,38 +2,52 @@ import click
 import json
 import os
 import random
-import re
 import requests
+import time
 
-from flask import Flask, abort, redirect, render_template, request, url_for
+from flask import Flask, Response, abort, g, redirect, render_template, request, url_for
 from flask_menu import Menu, register_menu
 
 from .db import (init_db,
-                    create_team_table,
-                    delete_team_table,
                     get_team_config,
+                    get_leaderboards,
+                    get_period_leaderboards,
+                    get_rollup_buckets,
+                    get_team_ids,
                     get_team_user,
-                    get_team_users,
                     get_teams_info,
+                    migrate_schema,
+                    QuotaExceeded,
                     reset_all_team_scores,
-                    reset_team_quotas,
                     reset_team_scores,
                     update_team_config,
-                    update_team_user)
+                    update_team_users)
 from .constants import (AFFIRMATIONS,
                            BANANA_URLS,
                            DAYO_URLS)
 from .db import get_bot_id
 from .decorators import memoize, task
 from .slack import (get_client,
+                    get_max_content_length,
                     handle_request,
                     on,
                     post_message,
                     valid_request)
 from .utilities import (get_reward_emojis,
+                        get_team_day,
                         get_troll_emojis,
                         get_user_info,
-                        get_user_name)
+                        get_user_name,
+                        get_users_info,
+                        is_scoring_message,
+                        is_scoring_reaction,
+                        match_message,
+                        refresh_user_profiles)
+from .leaderboard import (get_cached_leaderboards,
+                          get_rendered_leaderboards,
+                          set_rendered_leaderboards)
+from .metrics import observe, render_metrics, valid_metrics_token
+from .worker import run_worker
 
 def generate_leaderboard(team, users, column='rewards_received'):
     if column in ['trolls_received', 'trolls_given']:
@@ -46,46 +60,74 @@ def generate_leaderboard(team, users, column='rewards_received'):
     if not filtered_users:
         return None
     sorted_users = sorted(filtered_users, key=lambda u: u.get(column, 0), reverse=True)[:10]
+    infos = get_users_info(team['id'], [user['user_id'] for user in sorted_users])
     for index, user in enumerate(sorted_users):
-        info = get_user_info(team['id'], user['user_id'])
-        user_name = get_user_name(info)
+        user_name = get_user_name(infos[user['user_id']])
         leaderboard.append('%d. %s - %d %s' % (index+1, user_name, user.get(column, 0), emoji))
     return '\n'.join(leaderboard)
 
-@task
-def generate_leaderboards(team_id, event):
-    leaderboards = []
+LEADERBOARD_TITLES = [
+    ('rewards_received', 'Rewards Received'),
+    ('rewards_given', 'Rewards Given'),
+    ('trolls_received', 'Trolls'),
+    ('trolls_given', 'Troll Hunters'),
+]
 
-    team = get_team_config(team_id)
-    users = get_team_users(team_id)
+LEADERBOARD_COMMANDS = ['bananas', 'leaderboard', 'tally']
 
-    if users:
-        rewards_received = generate_leaderboard(team, users, 'rewards_received')
-        if rewards_received:
-            leaderboards.append('*Rewards Received*\n\n%s' % rewards_received)
+LEADERBOARD_PERIODS = {
+    'all': None,
+    'month': 'This Month',
+    'week': 'This Week',
+}
 
-        rewards_given = generate_leaderboard(team, users, 'rewards_given')
-        if rewards_given:
-            leaderboards.append('*Rewards Given*\n\n%s' % rewards_given)
+def parse_leaderboard_command(text):
+    words = (text or '').split()
 
-        trolls_received = generate_leaderboard(team, users, 'trolls_received')
-        if trolls_received:
-            leaderboards.append('*Trolls*\n\n%s' % trolls_received)
+    if len(words) == 1 and words[0] in LEADERBOARD_COMMANDS:
+        return 'all'
 
-        trolls_given = generate_leaderboard(team, users, 'trolls_given')
-        if trolls_given:
-            leaderboards.append('*Troll Hunters*\n\n%s' % trolls_given)
+    if len(words) == 2 and words[0] in LEADERBOARD_COMMANDS and words[1] in LEADERBOARD_PERIODS:
+        return words[1]
+
+def render_leaderboards(team, leaders):
+    leaderboards = []
+
+    for column, title in LEADERBOARD_TITLES:
+        leaderboard = generate_leaderboard(team, leaders[column], column)
+        if leaderboard:
+            leaderboards.append('*%s*\n\n%s' % (title, leaderboard))
 
     if not leaderboards:
         emoji = get_reward_emojis(team)[0]
         leaderboards.append('Needs moar :%s:' % emoji)
 
+    return '\n\n'.join(leaderboards)
+
+@task
+def generate_leaderboards(team_id, event, period='all'):
+    team = get_team_config(team_id)
+    columns = [column for column, title in LEADERBOARD_TITLES]
+
+    if period == 'all':
+        key = (team['reward_emojis'], team['troll_emojis'])
+        text = get_rendered_leaderboards(team_id, key)
+
+        if text is None:
+            leaders = get_cached_leaderboards(team_id, lambda team_id, limit: get_leaderboards(team_id, columns, limit))
+            text = render_leaderboards(team, leaders)
+            set_rendered_leaderboards(team_id, key, text)
+    else:
+        bucket = dict(get_rollup_buckets(get_team_day(team)))[period]
+        leaders = get_period_leaderboards(team_id, period, bucket, columns)
+        text = '_%s_\n\n%s' % (LEADERBOARD_PERIODS[period], render_leaderboards(team, leaders))
+
     if event['type'] == 'message':
         ts = None
     else:
         ts = event['ts']
 
-    post_message(team_id, '\n\n'.join(leaderboards), event['channel'], ts)
+    post_message(team_id, text, event['channel'], ts)
 
 @task
 def reset_team_table(team_id, event):
@@ -140,50 +182,77 @@ def generate_me(team_id, event):
     if text:
         post_message(team_id, text, event['channel'], event.get('thread_ts'))
 
-def update_users(team_id, channel, giver, recipients, score=1, report=True):
-    recipients = set(recipients)
+def get_affirmation():
+    if os.environ.get('PYTEST_CURRENT_TEST'):
+        return 'Done.'
+    return random.choice(AFFIRMATIONS)
+
+def get_quota(team, user_id, column, amount, day):
+    return {
+        'amount': amount,
+        'column': column,
+        'day': day,
+        'limit': int(team.get('daily_quota') or 0),
+        'user_id': user_id,
+    }
+
+def get_quota_message(team, remaining, emoji, giver):
+    if remaining:
+        return "You've only got %d of today's :%s: left, <@%s>." % (remaining, emoji, giver)
+    return "You've given all %d of today's :%s:, <@%s>." % (team['daily_quota'], emoji, giver)
+
+def update_users(team_id, channel, giver, recipients, score=1, report=True, message_ts=None):
+    recipients = list(dict.fromkeys(recipients))
     team = get_team_config(team_id)
     emoji = get_reward_emojis(team)[0]
 
     if giver in recipients:
         return ['No :%s: for you! _nice try, human_' % emoji]
 
-    if report:
-        output = []
+    infos = get_users_info(team_id, recipients)
 
+    scores = {}
+    events = []
     given = 0
 
     for recipient in recipients:
-        info = get_user_info(team_id, recipient)
-        if info['user']['is_bot']:
-            if report:
-                user_name = get_user_name(info)
-                output.append("%s is a bot. Bots don't need :%s:."  % (user_name, emoji))
-        else:
+        if not infos[recipient]['user']['is_bot']:
             given += score
-            user = update_team_user(team_id, recipient, 'rewards_received', score, giver)
+            scores[recipient] = {'rewards_received': score}
+            events.append({'giver': giver, 'recipient': recipient, 'kind': 'reward', 'delta': score, 'channel': channel, 'message_ts': message_ts})
 
-            if report:
-                user_name = get_user_name(info)
-                if os.environ.get('PYTEST_CURRENT_TEST'):
-                    affirmation = 'Done.'
-                else:
-                    affirmation = random.choice(AFFIRMATIONS)
-                output.append('%s %s has %d :%s:!'% (affirmation, user_name, user['rewards_received'], emoji))
+    scores[giver] = {'rewards_given': given}
 
-    update_team_user(team_id, giver, 'rewards_given', given)
+    day = get_team_day(team)
+    quota = get_quota(team, giver, 'rewards_given_today', given, day)
+    try:
+        users = update_team_users(team_id, scores, giver, quota, events, day)
+    except QuotaExceeded as exc:
+        if report:
+            return [get_quota_message(team, exc.remaining, emoji, giver)]
+        return
 
     if report:
+        output = []
+
+        for recipient in recipients:
+            user_name = get_user_name(infos[recipient])
+            if recipient in users and recipient in scores:
+                output.append('%s %s has %d :%s:!' % (get_affirmation(), user_name, users[recipient]['rewards_received'], emoji))
+            else:
+                output.append("%s is a bot. Bots don't need :%s:." % (user_name, emoji))
+
         return output
 
-def update_trolls(team_id, channel, giver, recipient, score=1, report=False):
+def update_trolls(team_id, channel, giver, recipient, score=1, report=False, message_ts=None):
     team = get_team_config(team_id)
     emoji = get_troll_emojis(team)[0]
 
     if report:
         output = []
 
-    given = 0
+    scores = {giver: {'trolls_given': 0}}
+    events = []
 
     info = get_user_info(team_id, recipient)
     if info['user']['is_bot']:
@@ -191,18 +260,22 @@ def update_trolls(team_id, channel, giver, recipient, score=1, report=False):
             user_name = get_user_name(info)
             output.append("%s is a bot. Bots don't need :%s:."  % (user_name, emoji))
     else:
-        given += score
-        user = update_team_user(team_id, recipient, 'trolls_received', score)
-
+        scores[giver]['trolls_given'] = score
+        scores.setdefault(recipient, {})['trolls_received'] = score
+        events.append({'giver': giver, 'recipient': recipient, 'kind': 'troll', 'delta': score, 'channel': channel, 'message_ts': message_ts})
+
+    day = get_team_day(team)
+    quota = get_quota(team, giver, 'trolls_given_today', scores[giver]['trolls_given'], day)
+    try:
+        users = update_team_users(team_id, scores, None, quota, events, day)
+    except QuotaExceeded as exc:
         if report:
-            user_name = get_user_name(info)
-            if os.environ.get('PYTEST_CURRENT_TEST'):
-                affirmation = 'Done.'
-            else:
-                affirmation = random.choice(AFFIRMATIONS)
-            output.append('%s %s has %d :%s:!'% (affirmation, user_name, user['trolls_received'], emoji))
+            return [get_quota_message(team, exc.remaining, emoji, giver)]
+        return
 
-    update_team_user(team_id, giver, 'trolls_given', given)
+    if report and recipient in users and 'trolls_received' in scores.get(recipient, {}):
+        user_name = get_user_name(info)
+        output.append('%s %s has %d :%s:!' % (get_affirmation(), user_name, users[recipient]['trolls_received'], emoji))
 
     if report:
         return output
@@ -220,25 +293,19 @@ def update_scores_message(team_id, event):
         ts = None
 
     team = get_team_config(team_id)
+    found = match_message(team, message['text'])
+    channel = event['channel']
 
-    for emoji in get_reward_emojis(team):
-        found = re.search(':%s:' % emoji, message['text'])
-        if found:
-            recipients = re.findall(r'<@([A-Z0-9]+)>', message['text'])
+    report = []
 
-            if recipients:
-                channel = event['channel']
-                report = update_users(team_id, channel, event['user'], recipients)
-                text = ' '.join(report)
-                post_message(team_id, text, channel, ts)
+    if found['rewards'] and found['mentions']:
+        report.extend(update_users(team_id, channel, event['user'], found['mentions'], found['rewards'], True, message.get('ts')))
 
-    for emoji in get_troll_emojis(team):
-        found = re.search(':%s:' % emoji, message['text'])
-        if found:
-            channel = event['channel']
-            report = update_trolls(team_id, channel, event['user'], event['user'])
-            text = ' '.join(report)
-            post_message(team_id, text, channel, ts)
+    if found['trolls']:
+        report.extend(update_trolls(team_id, channel, event['user'], event['user'], found['trolls'], True, message.get('ts')))
+
+    if report:
+        post_message(team_id, ' '.join(report), channel, ts)
 
 @task
 def update_scores_reaction(team_id, event):
@@ -246,16 +313,26 @@ def update_scores_reaction(team_id, event):
     score = 1
     if event['type'] == 'reaction_removed':
         score = -1
+    item = event.get('item', {})
     if event['reaction'] in get_reward_emojis(team) and event.get('item_user') and event['user'] != event['item_user']:
-        update_users(team_id, None, event['user'], [event['item_user']], score, False)
+        update_users(team_id, item.get('channel'), event['user'], [event['item_user']], score, False, item.get('ts'))
     elif event['reaction'] in get_troll_emojis(team) and event.get('item_user') and event['user'] != event['item_user']:
-        update_trolls(team_id, None, event['user'], event['item_user'], score, False)
+        update_trolls(team_id, item.get('channel'), event['user'], event['item_user'], score, False, item.get('ts'))
+
+def wants_message(payload):
+    event = payload['event']
+    if event.get('channel_type') == 'channel' and 'subtype' not in event:
+        return is_scoring_message(get_team_config(payload['team_id']), event.get('text'))
+    return event.get('channel_type') == 'im'
+
+def wants_reaction(payload):
+    return is_scoring_reaction(get_team_config(payload['team_id']), payload['event'])
 
-def handle_config(request):
-    team_id = request.form['team_id']
+def handle_config(form):
+    team_id = form['team_id']
     team = get_team_config(team_id)
     payload = {
-        'trigger_id': request.form['trigger_id'],
+        'trigger_id': form['trigger_id'],
         'dialog': {
             'callback_id': 'config',
             'title': 'Configure mrtallyman',
@@ -332,21 +409,49 @@ def handle_config(request):
                         },
                     ],
                 },
+                {
+                    'type': 'text',
+                    'label': 'Timezone',
+                    'name': 'timezone',
+                    'hint': 'Timezone in which daily quotas start again, for example Africa/Johannesburg.',
+                    'optional': True,
+                    'value': team.get('timezone') or 'UTC',
+                },
             ]
         },
     }
 
-    response = get_client(request.form['team_id']).dialog_open(**payload)
+    response = get_client(team_id).dialog_open(**payload)
 
     if not response['ok']:
         print(response)
 
+def handle_action(payload):
+    if payload['type'] == 'dialog_submission':
+        if payload['callback_id'] == 'config':
+            update_team_config(payload['team']['id'], **payload['submission'])
+        return True
+    return False
+
+def handle_command(form):
+    text = form['text']
+
+    if text == 'ping':
+        return 'Pong'
+
+    if text in ['config', 'configure']:
+        handle_config(form)
+
+    return ''
+
 def create_app(config=None):
     from dotenv import load_dotenv
     load_dotenv()
 
     app = Flask(__name__)
 
+    app.config['MAX_CONTENT_LENGTH'] = get_max_content_length()
+
     if config:
         app.config.from_mapping(config)
 
@@ -355,11 +460,25 @@ def create_app(config=None):
 
     Menu(app)
 
+    @app.before_request
+    def start_timer():
+        g.started = time.monotonic()
+
+    @app.after_request
+    def record_timer(response):
+        # Labelled with the route's path, the same as the aiohttp server.
+        if request.url_rule and request.url_rule.rule != '/metrics' and 'started' in g:
+            observe('mrtallyman_http_ack_seconds', time.monotonic() - g.started, endpoint=request.url_rule.rule)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if not valid_metrics_token(request.headers.get('Authorization')):
+            abort(403)
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
     @app.route('/slack/event', methods=['POST'])
     def event():
-        if 'X-Slack-Retry-Num' in request.headers:
-            return 'OK'
-
         response = handle_request(app, request)
 
         if response is True:
@@ -371,26 +490,14 @@ def create_app(config=None):
 
     @app.route('/slack/action', methods=['POST'])
     def action():
-        if valid_request(app, request):
-            payload = json.loads(request.form['payload'])
-            if payload['type'] == 'dialog_submission':
-                if payload['callback_id'] == 'config':
-                    update_team_config(payload['team']['id'], **payload['submission'])
-                return ''
+        if valid_request(app, request) and handle_action(json.loads(request.form['payload'])):
+            return ''
         abort(403)
 
     @app.route('/slack/command', methods=['POST'])
     def command():
         if valid_request(app, request):
-            text = request.form['text']
-
-            if text == 'ping':
-                return 'Pong'
-
-            if text in ['config', 'configure']:
-                handle_config(request)
-
-            return ''
+            return handle_command(request.form)
         abort(403)
 
     @app.route('/slack/auth', methods=['GET'])
@@ -419,7 +526,6 @@ def create_app(config=None):
                 'user_id': data['user_id'],
             }
             update_team_config(data['team_id'], **config)
-            create_team_table(data['team_id'])
 
             return redirect(url_for('thanks'))
         else:
@@ -471,10 +577,14 @@ def create_app(config=None):
             bot_id = get_bot_id(team_id)
             channel = event['channel']
 
-            if event['text'] in ['<@%s> leaderboard' % bot_id,
-                                '<@%s> tally' % bot_id,
-                                '<@%s> bananas' % bot_id]:
-                generate_leaderboards(team_id, event)
+            prefix = '<@%s> ' % bot_id
+            if event['text'].startswith(prefix):
+                period = parse_leaderboard_command(event['text'][len(prefix):])
+            else:
+                period = None
+
+            if period:
+                generate_leaderboards(team_id, event, period)
 
             elif event['text'] in ['<@%s> tally me' % bot_id,
                                    '<@%s> tallyme' % bot_id]:
@@ -486,7 +596,7 @@ def create_app(config=None):
             elif event['text'] == '<@%s> dayo' % bot_id:
                 post_message(team_id, random.choice(DAYO_URLS), channel, ts)
 
-    @on('message')
+    @on('message', when=wants_message)
     def message_event(payload):
         team_id = payload['team_id']
         event = payload['event']
@@ -499,19 +609,19 @@ def create_app(config=None):
         elif channel_type == 'im' and event_text == 'reset!':
             reset_team_table(team_id, event)
 
-        elif channel_type == 'im' and event_text in ['bananas', 'leaderboard', 'tally']:
-            generate_leaderboards(team_id, event)
+        elif channel_type == 'im' and parse_leaderboard_command(event_text):
+            generate_leaderboards(team_id, event, parse_leaderboard_command(event_text))
 
         elif channel_type == 'im' and event_text in ['tally me', 'tallyme']:
             generate_me(team_id, event)
 
-    @on('reaction_added')
+    @on('reaction_added', when=wants_reaction)
     def reaction_added_event(payload):
         team_id = payload['team_id']
         event = payload['event']
         update_scores_reaction(team_id, event)
 
-    @on('reaction_removed')
+    @on('reaction_removed', when=wants_reaction)
     def reaction_removed_event(payload):
         team_id = payload['team_id']
         event = payload['event']
@@ -522,14 +632,37 @@ def create_app(config=None):
         init_db(app)
         click.echo('Initialized the database')
 
+    @app.cli.command('migrate-schema')
+    @click.option('--batch-size', default=1000, help='Rows copied per transaction.')
+    @click.option('--drop', is_flag=True, help='Drop each team table once it has been copied.')
+    def migrate_schema_command(batch_size, drop):
+        migrate_schema(batch_size, drop, echo=click.echo)
+
     @app.cli.command('reset-scores')
     @click.argument('reset_interval')
-    def reset_scores_command(reset_interval):
-        reset_all_team_scores(reset_interval)
-
-    @app.cli.command('reset-quotas')
-    def reset_quotas_command():
-        reset_team_quotas()
+    @click.option('--chunk-size', default=1000, help='Rows scanned per transaction.')
+    @click.option('--run-key', help='Resume the run with this key instead of today\'s.')
+    def reset_scores_command(reset_interval, chunk_size, run_key):
+        result = reset_all_team_scores(reset_interval, chunk_size, run_key)
+        if result['skipped']:
+            click.echo('Already reset %d rows across %d teams' % (result['rows'], result['teams']))
+        else:
+            click.echo('Reset %d rows across %d teams in %.2fs' % (result['rows'], result['teams'], result['duration']))
+
+    @app.cli.command('refresh-users')
+    @click.argument('team_ids', nargs=-1)
+    def refresh_users_command(team_ids):
+        for team_id in team_ids or get_team_ids():
+            count = refresh_user_profiles(team_id)
+            click.echo('Refreshed %d users for team %s' % (count, team_id))
+
+    @app.cli.command('worker')
+    @click.option('--concurrency', default=4, help='Number of jobs processed at once.')
+    @click.option('--poll-interval', default=1.0, help='Seconds to wait when the queue is empty.')
+    @click.option('--lock-timeout', default=300, help='Seconds before a running job is considered abandoned.')
+    @click.option('--max-attempts', default=5, help='Attempts before a job is marked as failed.')
+    def worker_command(concurrency, poll_interval, lock_timeout, max_attempts):
+        run_worker(concurrency, poll_interval, lock_timeout, max_attempts, echo=click.echo)
 
     @app.context_processor
     def inject_google_analytics_id():
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+import time
+
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+
+from . import create_app, handle_action, handle_command
+from .client import log_failure
+from .metrics import observe, render_metrics, valid_metrics_token
+from .slack import accept_event, dispatch_event, get_max_content_length, handlers, valid_signature
+
+EXECUTOR = web.AppKey('executor', ThreadPoolExecutor)
+IN_FLIGHT = web.AppKey('in_flight', set)
+
+def run_handler(app, func, *args):
+    return asyncio.get_running_loop().run_in_executor(app[EXECUTOR], func, *args)
+
+def track(app, future):
+    app[IN_FLIGHT].add(future)
+    future.add_done_callback(app[IN_FLIGHT].discard)
+    future.add_done_callback(log_failure)
+
+async def read_verified(request):
+    body = await request.read()
+    timestamp = request.headers.get('X-Slack-Request-Timestamp')
+    signature = request.headers.get('X-Slack-Signature')
+
+    if timestamp and signature and valid_signature(timestamp, signature, body):
+        return body
+
+async def event(request):
+    body = await read_verified(request)
+    if body is None:
+        raise web.HTTPBadRequest()
+
+    payload = json.loads(body.decode('utf-8'))
+
+    if payload['type'] == 'url_verification':
+        return web.Response(text=payload['challenge'])
+
+    if payload['type'] == 'event_callback' and payload['event']['type'] in handlers:
+        funcs = await run_handler(request.app, accept_event, payload)
+        if funcs:
+            if os.environ.get('EVENT_QUEUE'):
+                await run_handler(request.app, dispatch_event, payload, funcs)
+            else:
+                # Slack only waits for the ack, so handlers run after the response.
+                track(request.app, run_handler(request.app, dispatch_event, payload, funcs))
+        return web.Response(text='OK')
+
+    raise web.HTTPBadRequest()
+
+async def action(request):
+    if await read_verified(request) is not None:
+        form = await request.post()
+        if await run_handler(request.app, handle_action, json.loads(form['payload'])):
+            return web.Response(text='')
+    raise web.HTTPForbidden()
+
+async def command(request):
+    if await read_verified(request) is not None:
+        form = await request.post()
+        return web.Response(text=await run_handler(request.app, handle_command, form))
+    raise web.HTTPForbidden()
+
+@web.middleware
+async def record_timer(request, handler):
+    started = time.monotonic()
+    try:
+        return await handler(request)
+    finally:
+        # Requests that match no route are left out, so unknown paths can't
+        # add series.
+        resource = request.match_info.route.resource
+        if resource is not None and resource.canonical != '/metrics':
+            observe('mrtallyman_http_ack_seconds', time.monotonic() - started, endpoint=resource.canonical)
+
+async def metrics(request):
+    if not valid_metrics_token(request.headers.get('Authorization')):
+        raise web.HTTPForbidden()
+    text = await run_handler(request.app, render_metrics)
+    return web.Response(text=text, content_type='text/plain')
+
+async def shutdown(app):
+    if app[IN_FLIGHT]:
+        await asyncio.gather(*app[IN_FLIGHT], return_exceptions=True)
+    app[EXECUTOR].shutdown(wait=True)
+
+def make_app():
+    app = web.Application(client_max_size=get_max_content_length(), middlewares=[record_timer])
+    app[EXECUTOR] = ThreadPoolExecutor(max_workers=int(os.environ.get('ASYNC_WORKERS', 32)), thread_name_prefix='handler')
+    app[IN_FLIGHT] = set()
+
+    app.router.add_post('/slack/event', event)
+    app.router.add_post('/slack/action', action)
+    app.router.add_post('/slack/command', command)
+    app.router.add_get('/metrics', metrics)
+    app.on_cleanup.append(shutdown)
+
+    return app
+
+def create_aio_app(config=None):
+    # The Flask app loads the environment, sets up the database and
+    # registers the event handlers.
+    create_app(config)
+
+    # Handlers already run off the event loop, so tasks run inline in the
+    # handler threads instead of being handed to another pool.
+    os.environ['TASK_EXECUTOR'] = 'sync'
+
+    return make_app()
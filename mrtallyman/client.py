@@ -0,0 +1,169 @@
+import aiohttp
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
+import traceback
+
+from slack.errors import SlackApiError
+
+from .metrics import increment, timer
+
+DEFAULT_API_URL = 'https://www.slack.com/api/'
+
+# Requests per second and burst size per token and method, roughly following
+# the Slack Web API rate limit tiers.
+RATE_LIMITS = {
+    'auth.test': (1.5, 20),
+    'chat.postMessage': (1, 5),
+    'dialog.open': (1.5, 20),
+    'users.info': (1.5, 20),
+    'users.list': (0.3, 5),
+}
+DEFAULT_RATE_LIMIT = (0.3, 5)
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+_session = None
+_buckets = {}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def get_bucket(token, method):
+    key = (token, method)
+
+    if key not in _buckets:
+        _buckets[key] = TokenBucket(*RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))
+
+    return _buckets[key]
+
+def get_loop():
+    global _loop, _loop_pid, _session, _buckets
+
+    if _loop_pid == os.getpid():
+        return _loop
+
+    with _loop_lock:
+        if _loop_pid != os.getpid():
+            # The loop thread does not survive a fork, so each process
+            # starts its own loop and connection pool.
+            _loop = asyncio.new_event_loop()
+            _session = None
+            _buckets = {}
+            thread = threading.Thread(target=_loop.run_forever, name='slack-client', daemon=True)
+            thread.start()
+            _loop_pid = os.getpid()
+
+    return _loop
+
+def get_session():
+    global _session
+
+    if _session is None:
+        connector = aiohttp.TCPConnector(
+            limit=int(os.environ.get('SLACK_MAX_CONNECTIONS', 20)),
+            keepalive_timeout=60,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=float(os.environ.get('SLACK_TIMEOUT', 30))),
+        )
+
+    return _session
+
+def close_client():
+    global _session
+
+    if _loop_pid != os.getpid() or _session is None:
+        return
+
+    asyncio.run_coroutine_threadsafe(_session.close(), _loop).result(timeout=5)
+    _session = None
+
+atexit.register(close_client)
+
+async def api_call(token, method, params, max_retries=3):
+    url = os.environ.get('SLACK_API_URL', DEFAULT_API_URL) + method
+    # Form fields are flat strings, so structured arguments such as a dialog
+    # or blocks are sent as JSON, the way Slack expects them.
+    data = {key: json.dumps(value) if isinstance(value, (bool, dict, list)) else value for key, value in params.items() if value is not None}
+    bucket = get_bucket(token, method)
+
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+
+        with timer('mrtallyman_slack_api_seconds', method=method):
+            async with get_session().post(url, data=data, headers={'Authorization': 'Bearer %s' % token}) as response:
+                if response.status == 429 and attempt < max_retries:
+                    retry_after = float(response.headers.get('Retry-After', 1))
+                    increment('mrtallyman_slack_rate_limited_total', method=method)
+                    bucket.block(retry_after)
+                    continue
+
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    # Gateway errors and outages come back as HTML or plain
+                    # text rather than a Slack response.
+                    body = {'ok': False, 'error': 'http_%d' % response.status}
+
+        if not body.get('ok'):
+            raise SlackApiError('The request to the Slack API failed.', body)
+
+        return body
+
+def log_failure(future):
+    exc = future.exception()
+    if exc:
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+class AsyncWebClient:
+    def __init__(self, token):
+        self.token = token
+
+    def submit(self, method, **params):
+        return asyncio.run_coroutine_threadsafe(api_call(self.token, method, params), get_loop())
+
+    def api_call(self, method, **params):
+        return self.submit(method, **params).result()
+
+    def post_later(self, **params):
+        future = self.submit('chat.postMessage', **params)
+        future.add_done_callback(log_failure)
+        return future
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        method = name.replace('_', '.')
+        return lambda **params: self.api_call(method, **params)
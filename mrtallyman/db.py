@@ -1,15 +1,41 @@
+import atexit
+import json
 import pymysql
 import os
-import slack
+import sys
+import tempfile
+import threading
+import time
 
 from .decorators import memoize
+from .leaderboard import invalidate_leaderboards, record_scores
+from .metrics import register_collector, timer
+from .outbox import notify
 from .utilities import get_reward_emojis, team_log
-from .slack import get_bot_by_token, post_message
+from .slack import get_bot_by_token
 from contextlib import contextmanager
-from pymysql.err import ProgrammingError
+from datetime import date, timedelta
+from pymysql.err import InterfaceError, OperationalError, ProgrammingError
 
-@contextmanager
-def db_cursor():
+pool_stats = {
+    'acquired': 0,
+    'created': 0,
+    'discarded': 0,
+    'recycled': 0,
+    'wait_max': 0.0,
+    'wait_total': 0.0,
+}
+
+_pool = None
+_pool_lock = None
+_pool_pid = None
+_pool_slots = None
+
+SCORE_COLUMNS = ['rewards_received', 'rewards_given', 'trolls_received', 'trolls_given']
+USERS_TABLE = 'team_users'
+USERS_PARTITIONS = 16
+
+def connect():
     db = pymysql.connect(
         host=os.environ.get('MYSQL_HOST', '127.0.0.1'),
         port=int(os.environ.get('MYSQL_PORT', 3306)),
@@ -20,22 +46,162 @@ def db_cursor():
         charset='utf8mb4',
         cursorclass=pymysql.cursors.DictCursor)
     db.show_warnings()
+    pool_stats['created'] += 1
+    return db
+
+def reset_pool():
+    global _pool, _pool_lock, _pool_pid, _pool_slots
+
+    # Connections inherited across a fork share sockets with the parent,
+    # so the child just forgets them rather than closing them.
+    _pool = []
+    _pool_lock = threading.Lock()
+    _pool_pid = os.getpid()
+    _pool_slots = threading.BoundedSemaphore(int(os.environ.get('MYSQL_POOL_SIZE', 4)))
+
+def close_pool():
+    if _pool_pid != os.getpid():
+        return
+
+    with _pool_lock:
+        while _pool:
+            db, created, last_used = _pool.pop()
+            db.close()
+
+def discard_connection(db):
+    pool_stats['discarded'] += 1
+    try:
+        db.close()
+    except pymysql.err.Error:
+        pass
+
+def acquire_connection():
+    if _pool_pid != os.getpid():
+        reset_pool()
+
+    timeout = float(os.environ.get('MYSQL_POOL_TIMEOUT', 10))
+    recycle = float(os.environ.get('MYSQL_POOL_RECYCLE', 3600))
+    ping_after = float(os.environ.get('MYSQL_POOL_PING_AFTER', 30))
+
+    started = time.monotonic()
+    if not _pool_slots.acquire(timeout=timeout):
+        raise OperationalError(2013, 'Timed out waiting for a pooled connection')
+    now = time.monotonic()
+
+    wait = now - started
+    pool_stats['acquired'] += 1
+    pool_stats['wait_total'] += wait
+    pool_stats['wait_max'] = max(pool_stats['wait_max'], wait)
+
+    try:
+        while True:
+            with _pool_lock:
+                if not _pool:
+                    break
+                db, created, last_used = _pool.pop()
+
+            if now - created > recycle:
+                pool_stats['recycled'] += 1
+                db.close()
+                continue
+
+            if now - last_used > ping_after:
+                try:
+                    db.ping(reconnect=False)
+                except pymysql.err.Error:
+                    discard_connection(db)
+                    continue
+
+            return db, created
+
+        return connect(), now
+    except BaseException:
+        _pool_slots.release()
+        raise
+
+def release_connection(db, created, broken=False):
+    try:
+        if broken or not db.open:
+            discard_connection(db)
+        else:
+            with _pool_lock:
+                _pool.append((db, created, time.monotonic()))
+    finally:
+        _pool_slots.release()
+
+def get_pool_stats():
+    stats = dict(pool_stats)
+    if _pool_pid == os.getpid():
+        stats['idle'] = len(_pool)
+    else:
+        stats['idle'] = 0
+    return stats
+
+atexit.register(close_pool)
+
+@register_collector
+def collect_pool_stats():
+    stats = get_pool_stats()
+    yield 'mrtallyman_db_pool_connections', {}, stats['idle']
+    for event in ['acquired', 'created', 'discarded', 'recycled']:
+        yield 'mrtallyman_db_pool_events_total', {'event': event}, stats[event]
+    yield 'mrtallyman_db_pool_wait_seconds_total', {}, stats['wait_total']
+
+class TimedCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
 
-    yield db.cursor()
+    def execute(self, sql, args=None):
+        # Labelled with the function that runs the statement, which is
+        # always the caller of this method.
+        with timer('mrtallyman_db_query_seconds', function=sys._getframe(1).f_code.co_name):
+            return self.cursor.execute(sql, args)
 
-    db.close()
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+@contextmanager
+def db_cursor():
+    db, created = acquire_connection()
+    broken = False
+
+    try:
+        with db.cursor() as cursor:
+            yield TimedCursor(cursor)
+    except (OperationalError, InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_connection(db, created, broken)
+
+@contextmanager
+def db_transaction():
+    db, created = acquire_connection()
+    broken = False
+
+    try:
+        db.begin()
+        with db.cursor() as cursor:
+            yield TimedCursor(cursor)
+        db.commit()
+    except (OperationalError, InterfaceError):
+        broken = True
+        raise
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        release_connection(db, created, broken)
 
 def get_table_name(suffix):
     return 'team_%s' % suffix
 
-@memoize
 def get_bot_access_token(team_id):
     team = get_team_config(team_id)
 
     if team:
         return team['bot_access_token']
 
-@memoize
 def get_bot_id(team_id):
     team = get_team_config(team_id)
 
@@ -61,23 +227,60 @@ def create_config_table():
         `troll_emojis` varchar(255),
         `reset_interval` varchar(255),
         `daily_quota` int,
+        `timezone` varchar(255),
         primary key (`id`)
     );''' % get_table_name('config')
 
     with db_cursor() as cursor:
         cursor.execute(sql)
 
-def create_team_table(team_id, channel=None):
-    table_name = get_table_name(team_id)
+def create_job_table():
+    if table_exists('job_queue'):
+        return
 
-    if table_exists(table_name):
+    sql = '''
+    CREATE TABLE `job_queue` (
+        `id` bigint auto_increment,
+        `payload` mediumtext not null,
+        `status` varchar(16) default 'pending' not null,
+        `attempts` int default 0 not null,
+        `created_at` double not null,
+        `available_at` double not null,
+        `locked_by` varchar(255),
+        `locked_at` double,
+        `last_error` text,
+        primary key (`id`),
+        key (`status`, `available_at`)
+    );'''
+
+    with db_cursor() as cursor:
+        cursor.execute(sql)
+
+def create_user_profile_table():
+    if table_exists('user_profiles'):
         return
 
-    team_log(team_id, 'Creating table %s' % table_name, channel)
+    sql = '''
+    CREATE TABLE `user_profiles` (
+        `team_id` varchar(255) not null,
+        `user_id` varchar(255) not null,
+        `info` mediumtext not null,
+        `fetched_at` double not null,
+        primary key (`team_id`, `user_id`)
+    );'''
+
+    with db_cursor() as cursor:
+        cursor.execute(sql)
+
+def create_team_users_table():
+    if table_exists(USERS_TABLE):
+        return
 
+    # Every unique key of a partitioned table has to include the
+    # partitioning column, so team_id leads all of them and there is no
+    # foreign key back to team_config.
     sql = '''
     CREATE TABLE `%s` (
-        `id` int auto_increment,
         `team_id` varchar(255) not null,
         `user_id` varchar(255) not null,
         `rewards_given` int default 0 not null,
@@ -86,75 +289,364 @@ def create_team_table(team_id, channel=None):
         `trolls_given` int default 0 not null,
         `trolls_given_today` int default 0 not null,
         `trolls_received` int default 0 not null,
-        primary key (`id`),
-        unique key (`team_id`, `user_id`),
-        foreign key (`team_id`) references `team_config`(`id`)
-    );''' % table_name
+        `quota_day` date,
+        primary key (`team_id`, `user_id`),
+        key `rewards_given` (`team_id`, `rewards_given`),
+        key `rewards_received` (`team_id`, `rewards_received`),
+        key `trolls_given` (`team_id`, `trolls_given`),
+        key `trolls_received` (`team_id`, `trolls_received`)
+    )
+    PARTITION BY KEY (`team_id`) PARTITIONS %d;''' % (USERS_TABLE, USERS_PARTITIONS)
 
     with db_cursor() as cursor:
         cursor.execute(sql)
 
-    team_log(team_id, 'Table %s created' % table_name, channel)
+def add_missing_columns(table_name, columns):
+    with db_cursor() as cursor:
+        cursor.execute('SHOW COLUMNS FROM `%s`' % table_name)
+        existing = set(column['Field'] for column in cursor.fetchall())
 
-def get_team_config(team_id):
+        missing = [name for name in columns if name not in existing]
+        if missing:
+            sql = 'ALTER TABLE `%s` ' % table_name + ', '.join('ADD COLUMN `%s` %s' % (name, columns[name]) for name in missing)
+            cursor.execute(sql)
+
+def create_score_event_tables():
+    if not table_exists('score_events'):
+        sql = '''
+        CREATE TABLE `score_events` (
+            `id` bigint auto_increment,
+            `team_id` varchar(255) not null,
+            `giver_id` varchar(255) not null,
+            `recipient_id` varchar(255) not null,
+            `kind` varchar(16) not null,
+            `delta` int not null,
+            `created_at` double not null,
+            `channel` varchar(255),
+            `message_ts` varchar(255),
+            `day` date,
+            primary key (`id`),
+            key (`team_id`, `created_at`),
+            key `message` (`team_id`, `channel`, `message_ts`)
+        );'''
+
+        with db_cursor() as cursor:
+            cursor.execute(sql)
+
+    if not table_exists('score_rollups'):
+        sql = '''
+        CREATE TABLE `score_rollups` (
+            `team_id` varchar(255) not null,
+            `period` varchar(8) not null,
+            `bucket` date not null,
+            `column` varchar(32) not null,
+            `user_id` varchar(255) not null,
+            `total` int default 0 not null,
+            primary key (`team_id`, `period`, `bucket`, `column`, `user_id`),
+            key `leaderboard` (`team_id`, `period`, `bucket`, `column`, `total`)
+        );'''
+
+        with db_cursor() as cursor:
+            cursor.execute(sql)
+
+def create_migration_table():
+    if table_exists('schema_migrations'):
+        return
+
+    sql = '''
+    CREATE TABLE `schema_migrations` (
+        `table_name` varchar(255) not null,
+        `last_id` int default 0 not null,
+        `done` tinyint default 0 not null,
+        primary key (`table_name`)
+    );'''
+
+    with db_cursor() as cursor:
+        cursor.execute(sql)
+
+def load_team_config(team_id):
     sql = 'SELECT * FROM `team_config` WHERE `id` = %s'
 
     with db_cursor() as cursor:
         cursor.execute(sql, (team_id,))
         return cursor.fetchone()
 
+def get_config_signal_path():
+    default = os.path.join(tempfile.gettempdir(), 'mrtallyman-%s.config' % os.environ.get('MYSQL_DATABASE'))
+    return os.environ.get('CONFIG_SIGNAL_PATH', default)
+
+def get_config_version():
+    try:
+        stat = os.stat(get_config_signal_path())
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+def signal_config_change():
+    # Replacing the file gives it a new inode, so every worker on the host
+    # sees a new version even when two writes land in the same clock tick.
+    path = get_config_signal_path()
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as signal_file:
+        signal_file.write(str(time.time()))
+    os.replace(signal_file.name, path)
+
+@memoize(maxsize=4096, ttl=300)
+def get_versioned_team_config(team_id, version):
+    return load_team_config(team_id)
+
+def get_team_config(team_id):
+    team = get_versioned_team_config(team_id, get_config_version())
+
+    if team:
+        return dict(team)
+
 def get_team_user(team_id, user_id):
-    sql = 'SELECT * FROM `team_%s`' % team_id + ' WHERE `user_id` = %s'
+    sql = 'SELECT * FROM `team_users` WHERE `team_id` = %s AND `user_id` = %s'
 
     with db_cursor() as cursor:
-        cursor.execute(sql, (user_id,))
+        cursor.execute(sql, (team_id, user_id))
         return cursor.fetchone()
 
 def get_team_users(team_id):
-    sql = 'SELECT * FROM `team_%s`' % team_id
+    sql = 'SELECT * FROM `team_users` WHERE `team_id` = %s'
 
     with db_cursor() as cursor:
-        cursor.execute(sql)
+        cursor.execute(sql, (team_id,))
         return cursor.fetchall()
 
-def get_teams_info():
-    info = []
+def group_leaderboards(rows, columns):
+    leaderboards = {column: [] for column in columns}
+    for row in rows:
+        leaderboards[row['board']].append({'user_id': row['user_id'], row['board']: row['score']})
+
+    # UNION ALL doesn't keep the order of its parts, and the cached boards
+    # rely on the lowest score being last.
+    for column, board in leaderboards.items():
+        board.sort(key=lambda row: row[column], reverse=True)
+
+    return leaderboards
+
+def get_leaderboards(team_id, columns=None, limit=10):
+    columns = columns or SCORE_COLUMNS
+
+    selects = []
+    args = []
+    for column in columns:
+        selects.append('(SELECT %%s AS `board`, `user_id`, `%s` AS `score` FROM `team_users` WHERE `team_id` = %%s AND `%s` > 0 ORDER BY `%s` DESC LIMIT %%s)' % (column, column, column))
+        args.extend([column, team_id, limit])
 
     with db_cursor() as cursor:
-        sql = 'SELECT * FROM `team_config` ORDER BY `team_name`'
-        cursor.execute(sql)
+        cursor.execute(' UNION ALL '.join(selects), args)
+        rows = cursor.fetchall()
+
+    return group_leaderboards(rows, columns)
+
+def get_period_leaderboards(team_id, period, bucket, columns=None, limit=10):
+    columns = columns or SCORE_COLUMNS
+
+    select = '(SELECT `column` AS `board`, `user_id`, `total` AS `score` FROM `score_rollups`' \
+        + ' WHERE `team_id` = %s AND `period` = %s AND `bucket` = %s AND `column` = %s AND `total` > 0' \
+        + ' ORDER BY `total` DESC LIMIT %s)'
+    args = []
+    for column in columns:
+        args.extend([team_id, period, bucket, column, limit])
+
+    with db_cursor() as cursor:
+        cursor.execute(' UNION ALL '.join([select] * len(columns)), args)
+        rows = cursor.fetchall()
+
+    return group_leaderboards(rows, columns)
+
+def get_teams_info():
+    with db_cursor() as cursor:
+        cursor.execute('SELECT * FROM `team_config` ORDER BY `team_name`')
         teams = cursor.fetchall()
 
-        for team in teams:
-            with db_cursor() as users_cursor:
-                sql = 'SELECT COUNT(*) AS `user_count` FROM `team_%s`' % team['id']
-                users_cursor.execute(sql)
-                result = users_cursor.fetchone()
-                info.append({'team': team, 'user_count': result['user_count']})
+        cursor.execute('SELECT `team_id`, COUNT(*) AS `user_count` FROM `team_users` GROUP BY `team_id`')
+        counts = {row['team_id']: row['user_count'] for row in cursor.fetchall()}
 
-    return info
+    return [{'team': team, 'user_count': counts.get(team['id'], 0)} for team in teams]
 
 def update_team_user(team_id, user_id, attribute, value, giver=None):
-    user = get_team_user(team_id, user_id)
+    # LAST_INSERT_ID(expr) hands the new value of an existing row back with
+    # the statement's result, so the upsert and the read are one round trip.
+    # A new row is reported as one affected row and holds the clamped value.
+    sql = 'INSERT INTO `team_users` (`team_id`, `user_id`, `%s`)' % attribute \
+        + ' VALUES (%s, %s, GREATEST(0, %s))' \
+        + ' ON DUPLICATE KEY UPDATE `%s` = LAST_INSERT_ID(GREATEST(0, `%s` + ' % (attribute, attribute) + '%s))'
+
+    with db_cursor() as cursor:
+        inserted = cursor.execute(sql, (team_id, user_id, value, value)) == 1
+        score = max(0, value) if inserted else cursor.lastrowid
 
-    if user:
-        user[attribute] = max(0, user[attribute] + value)
+    user = {'team_id': team_id, 'user_id': user_id, attribute: score}
 
-        sql = 'UPDATE `team_%s` SET `%s`' % (team_id, attribute) + ' = %s WHERE `user_id` = %s'
-        args = (user[attribute], user_id)
+    record_scores(team_id, [user])
 
-        with db_cursor() as cursor:
-            cursor.execute(sql, args)
+    if giver and value > 0:
+        team = get_team_config(team_id)
+        emoji = get_reward_emojis(team)[0]
+        notify(team_id, user_id, giver, emoji, value)
+
+    return user
+
+def get_rollup_buckets(day):
+    return [
+        ('day', day),
+        ('week', day - timedelta(days=day.weekday())),
+        ('month', day.replace(day=1)),
+    ]
+
+EVENT_COLUMNS = {
+    'reward': ('rewards_given', 'rewards_received'),
+    'troll': ('trolls_given', 'trolls_received'),
+}
+
+def get_original_day(cursor, team_id, event):
+    # A removal counts against the day its reaction was added on, so the
+    # rollups of that day, week and month are the ones that come down.
+    if not event.get('message_ts'):
+        return None
+
+    sql = '''SELECT `day` FROM `score_events`
+        WHERE `team_id` = %s AND `channel` = %s AND `message_ts` = %s
+            AND `giver_id` = %s AND `recipient_id` = %s AND `kind` = %s AND `delta` > 0
+        ORDER BY `id` DESC LIMIT 1'''
+    cursor.execute(sql, (team_id, event.get('channel'), event['message_ts'], event['giver'], event['recipient'], event['kind']))
+    original = cursor.fetchone()
+
+    return original['day'] if original else None
+
+def add_original_days(cursor, team_id, events):
+    return [dict(event, original_day=get_original_day(cursor, team_id, event)) if event['delta'] < 0 else event for event in events]
+
+def record_score_events(cursor, team_id, events, day):
+    now = time.time()
+    totals = {}
+
+    for event in events:
+        event_day = day if event['delta'] > 0 else event.get('original_day')
+        if not event_day:
+            continue
 
-        if giver and value > 0:
+        given, received = EVENT_COLUMNS[event['kind']]
+        for column, user_id in [(given, event['giver']), (received, event['recipient'])]:
+            for period, bucket in get_rollup_buckets(event_day):
+                key = (team_id, period, bucket, column, user_id)
+                totals[key] = totals.get(key, 0) + event['delta']
+
+    sql = 'INSERT INTO `score_events` (`team_id`, `giver_id`, `recipient_id`, `kind`, `delta`, `created_at`, `channel`, `message_ts`, `day`) VALUES ' \
+        + ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(events))
+    args = []
+    for event in events:
+        args.extend([team_id, event['giver'], event['recipient'], event['kind'], event['delta'], now, event.get('channel'), event.get('message_ts'), day])
+    cursor.execute(sql, args)
+
+    rows = [list(key) + [total] for key, total in totals.items() if total]
+
+    if rows:
+        # Clamped like the counters in team_users, for removals of rewards
+        # that were never counted.
+        sql = 'INSERT INTO `score_rollups` (`team_id`, `period`, `bucket`, `column`, `user_id`, `total`) VALUES ' \
+            + ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(rows)) \
+            + ' ON DUPLICATE KEY UPDATE `total` = GREATEST(0, `total` + VALUES(`total`))'
+        cursor.execute(sql, [value for row in rows for value in row])
+
+class QuotaExceeded(Exception):
+    def __init__(self, remaining):
+        super().__init__(remaining)
+        self.remaining = remaining
+
+def update_team_users(team_id, scores, giver=None, quota=None, events=None, day=None):
+    if not scores:
+        return {}
+
+    # Sorted so concurrent batches take row locks in the same order.
+    user_ids = sorted(scores.keys())
+    placeholders = ', '.join(['%s'] * len(user_ids))
+
+    insert_sql = 'INSERT INTO `team_users` (`team_id`, `user_id`) VALUES ' \
+        + ', '.join(['(%s, %s)'] * len(user_ids)) \
+        + ' ON DUPLICATE KEY UPDATE `user_id` = `user_id`'
+    insert_args = []
+    for user_id in user_ids:
+        insert_args.extend([team_id, user_id])
+
+    assignments = []
+    update_args = []
+    columns = sorted(set(column for attrs in scores.values() for column in attrs))
+    for column in columns:
+        cases = []
+        for user_id in user_ids:
+            value = scores[user_id].get(column, 0)
+            if value:
+                cases.append('WHEN %s THEN %s')
+                update_args.extend([user_id, value])
+        if cases:
+            assignments.append('`%s` = GREATEST(0, `%s` + CASE `user_id` ' % (column, column) + ' '.join(cases) + ' ELSE 0 END)')
+    update_sql = 'UPDATE `team_users` SET ' + ', '.join(assignments) + ' WHERE `team_id` = %s AND `user_id` IN (' + placeholders + ')'
+
+    select_sql = 'SELECT * FROM `team_users` WHERE `team_id` = %s AND `user_id` IN (' + placeholders + ')'
+
+    with db_transaction() as cursor:
+        cursor.execute(insert_sql, insert_args)
+        if events:
+            events = add_original_days(cursor, team_id, events)
+        if quota and quota['amount'] > 0 and not consume_quota(cursor, team_id, **quota):
+            # Raising rolls back the insert along with everything else.
+            raise QuotaExceeded(get_quota_remaining(cursor, team_id, **quota))
+        if quota and quota['amount'] < 0 and events:
+            refund_quota(cursor, team_id, events, **quota)
+        if assignments:
+            cursor.execute(update_sql, update_args + [team_id] + user_ids)
+        if events:
+            record_score_events(cursor, team_id, events, day or date.today())
+        cursor.execute(select_sql, [team_id] + user_ids)
+        users = {user['user_id']: user for user in cursor.fetchall()}
+
+    record_scores(team_id, users.values())
+
+    if giver:
+        recipients = [user_id for user_id in user_ids if user_id != giver and scores[user_id].get('rewards_received', 0) > 0]
+        if recipients:
             team = get_team_config(team_id)
             emoji = get_reward_emojis(team)[0]
-            giver = '<@%s>' % giver
-            post_message(team_id, 'You received a :%s: from %s!' % (emoji, giver), user_id)
-    else:
-        user = create_team_user(team_id, user_id, **{attribute: max(0, value)})
+            for recipient in recipients:
+                notify(team_id, recipient, giver, emoji, scores[recipient]['rewards_received'])
 
-    return user
+    return users
+
+def consume_quota(cursor, team_id, user_id, column, amount, limit, day):
+    # The counter belongs to quota_day and starts again from zero on the
+    # first write of a new day. MySQL applies the assignments left to right,
+    # so the counter is computed before quota_day moves on. No row matches
+    # when the amount would go over the limit.
+    current = 'IF(`quota_day` = %%s, `%s`, 0)' % column
+    sql = 'UPDATE `team_users` SET `%s` = ' % column + current + ' + %s, `quota_day` = %s' \
+        + ' WHERE `team_id` = %s AND `user_id` = %s AND (%s = 0 OR ' + current + ' + %s <= %s)'
+    args = (day, amount, day, team_id, user_id, limit or 0, day, amount, limit or 0)
+
+    return cursor.execute(sql, args) == 1
+
+def refund_quota(cursor, team_id, events, user_id, column, amount, limit, day):
+    # Only removals of rewards given on the quota's day are refunded, so
+    # removing old reactions can't win back today's quota. Nothing checks
+    # the row count, which pymysql reports as changed rather than matched
+    # rows, so a counter already at zero is not an error.
+    refund = sum(-event['delta'] for event in events if event['delta'] < 0 and event.get('original_day') == day)
+    if not refund:
+        return
+
+    sql = 'UPDATE `team_users` SET `%s` = GREATEST(0, `%s` - %%s)' % (column, column) \
+        + ' WHERE `team_id` = %s AND `user_id` = %s AND `quota_day` = %s'
+    cursor.execute(sql, (refund, team_id, user_id, day))
+
+def get_quota_remaining(cursor, team_id, user_id, column, amount, limit, day):
+    sql = 'SELECT IF(`quota_day` = %%s, `%s`, 0) AS `used` FROM `team_users` WHERE `team_id` = %%s AND `user_id` = %%s' % column
+    cursor.execute(sql, (day, team_id, user_id))
+    user = cursor.fetchone()
+
+    return max(0, (limit or 0) - (user['used'] if user else 0))
 
 def create_team_user(team_id, user_id, **attrs):
     user = {
@@ -169,28 +661,32 @@ def create_team_user(team_id, user_id, **attrs):
     }
     user.update(attrs)
 
-    sql = 'INSERT INTO `team_%s`' % team_id + ' (`team_id`, `user_id`, `rewards_given`, `rewards_given_today`, `rewards_received`, `trolls_given`, `trolls_given_today`, `trolls_received`) values (%(team_id)s, %(user_id)s, %(rewards_given)s, %(rewards_given_today)s, %(rewards_received)s, %(trolls_given)s, %(trolls_given_today)s, %(trolls_received)s)'
+    sql = 'INSERT INTO `team_users` (`team_id`, `user_id`, `rewards_given`, `rewards_given_today`, `rewards_received`, `trolls_given`, `trolls_given_today`, `trolls_received`) values (%(team_id)s, %(user_id)s, %(rewards_given)s, %(rewards_given_today)s, %(rewards_received)s, %(trolls_given)s, %(trolls_given_today)s, %(trolls_received)s)'
 
     with db_cursor() as cursor:
         cursor.execute(sql, user)
 
+    record_scores(team_id, [user])
+
     return user
 
 def delete_team_user(team_id, user_id):
-    sql = 'DELETE FROM `team_%s`' % team_id + ' WHERE `user_id` = %s'
+    sql = 'DELETE FROM `team_users` WHERE `team_id` = %s AND `user_id` = %s'
 
     with db_cursor() as cursor:
-        cursor.execute(sql, (user_id,))
+        cursor.execute(sql, (team_id, user_id))
+
+    invalidate_leaderboards(team_id)
 
 def update_team_config(team_id, **attrs):
-    team = get_team_config(team_id)
+    team = load_team_config(team_id)
 
     if team:
         sql = 'UPDATE `team_config` SET ' + ', '.join([f'`{key}` = %({key})s' for key in attrs.keys()]) + ' WHERE `id` = %(id)s'
         args = attrs
         args['id'] = team_id
     else:
-        sql = 'INSERT INTO `team_config` (id, team_name, access_token, bot_access_token, bot_user_id, reward_emojis, troll_emojis, reset_interval, daily_quota, user_id) values (%(id)s, %(team_name)s, %(access_token)s, %(bot_access_token)s, %(bot_user_id)s, %(reward_emojis)s, %(troll_emojis)s, %(reset_interval)s, %(daily_quota)s, %(user_id)s)'
+        sql = 'INSERT INTO `team_config` (id, team_name, access_token, bot_access_token, bot_user_id, reward_emojis, troll_emojis, reset_interval, daily_quota, timezone, user_id) values (%(id)s, %(team_name)s, %(access_token)s, %(bot_access_token)s, %(bot_user_id)s, %(reward_emojis)s, %(troll_emojis)s, %(reset_interval)s, %(daily_quota)s, %(timezone)s, %(user_id)s)'
         team = {
             'access_token': '',
             'bot_access_token': '',
@@ -200,6 +696,7 @@ def update_team_config(team_id, **attrs):
             'reset_interval': 'never',
             'reward_emojis': 'banana',
             'team_name': '',
+            'timezone': 'UTC',
             'troll_emojis': 'troll,trollface',
             'user_id': '',
         }
@@ -211,6 +708,8 @@ def update_team_config(team_id, **attrs):
 
     team.update(attrs)
 
+    signal_config_change()
+
     return team
 
 def table_exists(table_name):
@@ -224,64 +723,326 @@ def table_exists(table_name):
             return False
         raise exc
 
-def delete_team_table(team_id, channel):
-    table_name = get_table_name(team_id)
+def delete_team_users(team_id, channel):
+    sql = 'DELETE FROM `team_users` WHERE `team_id` = %s'
 
-    if not table_exists(table_name):
-        team_log(team_id, 'Table %s is not there' % table_name, channel)
-        return
+    with db_cursor() as cursor:
+        count = cursor.execute(sql, (team_id,))
 
-    sql = 'DROP TABLE `%s`' % table_name
+    invalidate_leaderboards(team_id)
 
-    with db_cursor() as cursor:
-        cursor.execute(sql)
+    if count:
+        team_log(team_id, 'Deleted %d users for team %s' % (count, team_id), channel)
+    else:
+        team_log(team_id, 'Team %s has no users' % team_id, channel)
 
-    team_log(team_id, 'Table %s deleted' % table_name, channel)
+def create_tables():
+    create_config_table()
+    create_team_users_table()
+    add_missing_columns('team_config', {'timezone': 'varchar(255)'})
+    add_missing_columns(USERS_TABLE, {'quota_day': 'date'})
+    create_job_table()
+    create_user_profile_table()
+    create_maintenance_table()
+    create_event_table()
+    create_score_event_tables()
 
 def init_db(app):
-    create_config_table()
+    create_tables()
 
     token = os.environ['SLACK_API_TOKEN']
-    client = slack.WebClient(token=token)
-    response = client.auth_test()
+    response = get_bot_by_token(token)
     if not response['ok']:
         abort(400)
-    create_team_table(response['team_id'])
     update_team_config(response['team_id'], team_name=response['team'], bot_access_token=token, bot_user_id=response['user_id'])
 
-def reset_all_team_scores(reset_interval):
+SCORE_RESET = {
+    'assignments': '''`rewards_given` = 0,
+        `rewards_given_today` = 0,
+        `rewards_received` = 0,
+        `trolls_given` = 0,
+        `trolls_given_today` = 0,
+        `trolls_received` = 0''',
+    'condition': '''`rewards_given` > 0
+        OR `rewards_given_today` > 0
+        OR `rewards_received` > 0
+        OR `trolls_given` > 0
+        OR `trolls_given_today` > 0
+        OR `trolls_received` > 0''',
+}
+
+def create_maintenance_table():
+    if table_exists('maintenance_runs'):
+        return
+
+    sql = '''
+    CREATE TABLE `maintenance_runs` (
+        `run_key` varchar(255) not null,
+        `last_team_id` varchar(255) default '' not null,
+        `last_user_id` varchar(255) default '' not null,
+        `rows` int default 0 not null,
+        `finished_at` double,
+        primary key (`run_key`)
+    );'''
+
     with db_cursor() as cursor:
-        sql = 'SELECT `id` FROM `team_config` WHERE `reset_interval` = %s'
-        cursor.execute(sql, (reset_interval,))
-        teams = cursor.fetchall()
-        team_ids = [team['id'] for team in teams]
+        cursor.execute(sql)
+
+def create_event_table():
+    if table_exists('seen_events'):
+        return
+
+    sql = '''
+    CREATE TABLE `seen_events` (
+        `event_id` varchar(255) not null,
+        `seen_at` double not null,
+        primary key (`event_id`),
+        key (`seen_at`)
+    );'''
+
+    with db_cursor() as cursor:
+        cursor.execute(sql)
+
+def claim_event(event_id):
+    # Only the first delivery of an event inserts a row.
+    sql = 'INSERT IGNORE INTO `seen_events` (`event_id`, `seen_at`) VALUES (%s, %s)'
+
+    with db_cursor() as cursor:
+        return cursor.execute(sql, (event_id, time.time())) == 1
+
+def unclaim_event(event_id):
+    with db_cursor() as cursor:
+        cursor.execute('DELETE FROM `seen_events` WHERE `event_id` = %s', (event_id,))
+
+def purge_events(max_age, limit=1000):
+    # Deleted in ranges of seen_at rather than with DELETE ... LIMIT, which
+    # is unsafe under statement-based replication, until none are left.
+    cutoff = time.time() - max_age
+    rows = 0
+
+    while True:
+        with db_cursor() as cursor:
+            cursor.execute('SELECT `seen_at` FROM `seen_events` WHERE `seen_at` < %s ORDER BY `seen_at` LIMIT 1 OFFSET %s', (cutoff, limit - 1))
+            bound = cursor.fetchone()
+            if bound:
+                rows += cursor.execute('DELETE FROM `seen_events` WHERE `seen_at` <= %s', (bound['seen_at'],))
+            else:
+                rows += cursor.execute('DELETE FROM `seen_events` WHERE `seen_at` < %s', (cutoff,))
+
+        if not bound:
+            return rows
+
+def reset_rows(reset, where, args, run_key=None, chunk_size=1000):
+    # One set-based UPDATE per range of the primary key, without a LIMIT, so
+    # each transaction stays small and replicates safely. The end of each
+    # range is saved with its UPDATE, so an interrupted run carries on from
+    # there when it is started again with the same run key.
+    started = time.monotonic()
+    last = ('', '')
+    rows = 0
+
+    if run_key:
+        with db_cursor() as cursor:
+            cursor.execute('SELECT * FROM `maintenance_runs` WHERE `run_key` = %s', (run_key,))
+            run = cursor.fetchone()
+
+        if run:
+            if run['finished_at']:
+                return {'duration': time.monotonic() - started, 'rows': run['rows'], 'skipped': True}
+            last = (run['last_team_id'], run['last_user_id'])
+            rows = run['rows']
+
+    tables = 'FROM `team_users` AS `u` JOIN `team_config` AS `c` ON `c`.`id` = `u`.`team_id`'
+    bound_sql = 'SELECT `u`.`team_id`, `u`.`user_id` ' + tables + ' WHERE ' + where \
+        + ' AND (`u`.`team_id`, `u`.`user_id`) > (%s, %s)' \
+        + ' ORDER BY `u`.`team_id`, `u`.`user_id` LIMIT 1 OFFSET %s'
+    update_sql = 'UPDATE `team_users` AS `u` JOIN `team_config` AS `c` ON `c`.`id` = `u`.`team_id`' \
+        + ' SET ' + reset['assignments'] + ' WHERE ' + where \
+        + ' AND (`u`.`team_id`, `u`.`user_id`) > (%s, %s)' \
+        + ' AND (' + reset['condition'] + ')'
+
+    while True:
+        with db_transaction() as cursor:
+            cursor.execute(bound_sql, list(args) + list(last) + [chunk_size - 1])
+            bound = cursor.fetchone()
+
+            if bound:
+                rows += cursor.execute(update_sql + ' AND (`u`.`team_id`, `u`.`user_id`) <= (%s, %s)',
+                                       list(args) + list(last) + [bound['team_id'], bound['user_id']])
+                last = (bound['team_id'], bound['user_id'])
+            else:
+                rows += cursor.execute(update_sql, list(args) + list(last))
+
+            if run_key:
+                sql = '''INSERT INTO `maintenance_runs` (`run_key`, `last_team_id`, `last_user_id`, `rows`, `finished_at`)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        `last_team_id` = VALUES(`last_team_id`),
+                        `last_user_id` = VALUES(`last_user_id`),
+                        `rows` = VALUES(`rows`),
+                        `finished_at` = VALUES(`finished_at`)'''
+                cursor.execute(sql, (run_key, last[0], last[1], rows, None if bound else time.time()))
+
+        if not bound:
+            return {'duration': time.monotonic() - started, 'rows': rows, 'skipped': False}
+
+def reset_all_team_scores(reset_interval, chunk_size=1000, run_key=None):
+    create_maintenance_table()
+
+    run_key = run_key or 'reset-scores:%s:%s' % (reset_interval, date.today().isoformat())
+    result = reset_rows(SCORE_RESET, '`c`.`reset_interval` = %s', [reset_interval], run_key, chunk_size)
+
+    with db_cursor() as cursor:
+        cursor.execute('SELECT `id` FROM `team_config` WHERE `reset_interval` = %s', (reset_interval,))
+        team_ids = [team['id'] for team in cursor.fetchall()]
 
     for team_id in team_ids:
-        reset_team_scores(team_id)
+        invalidate_leaderboards(team_id)
+
+    return dict(result, teams=len(team_ids))
 
 def reset_team_scores(team_id):
+    result = reset_rows(SCORE_RESET, '`u`.`team_id` = %s', [team_id])
+    invalidate_leaderboards(team_id)
+    return result['rows']
+
+def get_legacy_team_tables():
     with db_cursor() as cursor:
-        sql = ''''
-        UPDATE `team_%s`
-        SET rewards_given = 0,
-            rewards_given_today = 0,
-            rewards_received = 0,
-            trolls_given = 0,
-            trolls_given_today = 0,
-            trolls_received = 0
-        ''' % team_id
-        cursor.execute(sql)
+        cursor.execute("SHOW TABLES LIKE 'team\\_%'")
+        tables = [list(row.values())[0] for row in cursor.fetchall()]
+
+    return [table for table in tables if table not in ('team_config', USERS_TABLE)]
+
+def migrate_team_table(table_name, batch_size=1000):
+    columns = ['rewards_given', 'rewards_given_today', 'rewards_received', 'trolls_given', 'trolls_given_today', 'trolls_received']
+    copied = 0
+
+    while True:
+        with db_transaction() as cursor:
+            cursor.execute('SELECT `last_id`, `done` FROM `schema_migrations` WHERE `table_name` = %s FOR UPDATE', (table_name,))
+            progress = cursor.fetchone()
+
+            if not progress:
+                cursor.execute('INSERT INTO `schema_migrations` (`table_name`) VALUES (%s)', (table_name,))
+                progress = {'last_id': 0, 'done': 0}
+
+            if progress['done']:
+                return copied
+
+            cursor.execute('SELECT * FROM `%s`' % table_name + ' WHERE `id` > %s ORDER BY `id` LIMIT %s', (progress['last_id'], batch_size))
+            rows = cursor.fetchall()
+
+            if rows:
+                # Scores written to team_users since the deploy are kept and
+                # the legacy totals are added to them. The progress row is
+                # updated in the same transaction, so no batch is added twice.
+                sql = 'INSERT INTO `team_users` (`team_id`, `user_id`, ' + ', '.join('`%s`' % column for column in columns) + ') VALUES ' \
+                    + ', '.join(['(' + ', '.join(['%s'] * (len(columns) + 2)) + ')'] * len(rows)) \
+                    + ' ON DUPLICATE KEY UPDATE ' + ', '.join('`%s` = `%s` + VALUES(`%s`)' % (column, column, column) for column in columns)
+                args = []
+                for row in rows:
+                    args.extend([row['team_id'], row['user_id']] + [row[column] for column in columns])
+                cursor.execute(sql, args)
+
+                cursor.execute('UPDATE `schema_migrations` SET `last_id` = %s WHERE `table_name` = %s', (rows[-1]['id'], table_name))
+                copied += len(rows)
+
+            if len(rows) < batch_size:
+                cursor.execute('UPDATE `schema_migrations` SET `done` = 1 WHERE `table_name` = %s', (table_name,))
+                return copied
+
+def migrate_schema(batch_size=1000, drop=False, echo=print):
+    create_team_users_table()
+    create_migration_table()
+
+    for table_name in get_legacy_team_tables():
+        copied = migrate_team_table(table_name, batch_size)
+        echo('Copied %d users from %s' % (copied, table_name))
+
+        if drop:
+            with db_cursor() as cursor:
+                cursor.execute('DROP TABLE `%s`' % table_name)
+            echo('Dropped %s' % table_name)
+
+        invalidate_leaderboards(table_name[len('team_'):])
+
+def enqueue_job(payload):
+    now = time.time()
+    sql = 'INSERT INTO `job_queue` (`payload`, `created_at`, `available_at`) VALUES (%s, %s, %s)'
 
-def reset_team_quotas():
     with db_cursor() as cursor:
-        sql = 'SELECT `id` FROM `team_config`'
-        cursor.execute(sql)
-        teams = cursor.fetchall()
+        cursor.execute(sql, (json.dumps(payload), now, now))
+        return cursor.lastrowid
 
-        for team in teams:
-            sql = ''''
-            UPDATE `team_%s`
-            SET rewards_given_today = 0,
-                trolls_given_today = 0
-            ''' % team['id']
-            cursor.execute(sql)
+def claim_jobs(worker_id, limit, lock_timeout=300):
+    now = time.time()
+    sql = '''
+    SELECT `id`, `payload`, `attempts`, `created_at`, `available_at`
+    FROM `job_queue`
+    WHERE (`status` = 'pending' AND `available_at` <= %s)
+        OR (`status` = 'running' AND `locked_at` < %s)
+    ORDER BY `id`
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED'''
+
+    with db_transaction() as cursor:
+        cursor.execute(sql, (now, now - lock_timeout, limit))
+        jobs = cursor.fetchall()
+
+        if jobs:
+            ids = [job['id'] for job in jobs]
+            sql = "UPDATE `job_queue` SET `status` = 'running', `attempts` = `attempts` + 1, `locked_by` = %s, `locked_at` = %s" \
+                + ' WHERE `id` IN (' + ', '.join(['%s'] * len(ids)) + ')'
+            cursor.execute(sql, [worker_id, now] + ids)
+
+    for job in jobs:
+        job['attempts'] += 1
+        job['payload'] = json.loads(job['payload'])
+
+    return jobs
+
+def complete_job(job_id):
+    with db_cursor() as cursor:
+        cursor.execute('DELETE FROM `job_queue` WHERE `id` = %s', (job_id,))
+
+def fail_job(job, error, max_attempts=5):
+    if job['attempts'] >= max_attempts:
+        sql = "UPDATE `job_queue` SET `status` = 'failed', `locked_by` = NULL, `last_error` = %s WHERE `id` = %s"
+        args = (error, job['id'])
+    else:
+        sql = "UPDATE `job_queue` SET `status` = 'pending', `locked_by` = NULL, `last_error` = %s, `available_at` = %s WHERE `id` = %s"
+        args = (error, time.time() + 2 ** job['attempts'], job['id'])
+
+    with db_cursor() as cursor:
+        cursor.execute(sql, args)
+
+def get_user_profiles(team_id, user_ids, max_age):
+    if not user_ids:
+        return {}
+
+    sql = 'SELECT `user_id`, `info` FROM `user_profiles` WHERE `team_id` = %s AND `fetched_at` > %s' \
+        + ' AND `user_id` IN (' + ', '.join(['%s'] * len(user_ids)) + ')'
+
+    with db_cursor() as cursor:
+        cursor.execute(sql, [team_id, time.time() - max_age] + list(user_ids))
+        return {row['user_id']: json.loads(row['info']) for row in cursor.fetchall()}
+
+def save_user_profiles(team_id, infos):
+    if not infos:
+        return
+
+    now = time.time()
+    sql = 'INSERT INTO `user_profiles` (`team_id`, `user_id`, `info`, `fetched_at`) VALUES ' \
+        + ', '.join(['(%s, %s, %s, %s)'] * len(infos)) \
+        + ' ON DUPLICATE KEY UPDATE `info` = VALUES(`info`), `fetched_at` = VALUES(`fetched_at`)'
+    args = []
+    for user_id, info in infos.items():
+        args.extend([team_id, user_id, json.dumps(info), now])
+
+    with db_cursor() as cursor:
+        cursor.execute(sql, args)
+
+def get_team_ids():
+    with db_cursor() as cursor:
+        cursor.execute('SELECT `id` FROM `team_config` ORDER BY `id`')
+        return [team['id'] for team in cursor.fetchall()]
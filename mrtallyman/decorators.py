@@ -1,20 +1,176 @@
+import atexit
+import importlib
 import os
+import signal
+import threading
+import time
+import traceback
 
-from multiprocessing import Process
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import wraps
 
-def memoize(func):
+from .metrics import observe, register_collector
+
+_executor = None
+_executor_pid = None
+_executor_slots = None
+_executor_lock = threading.Lock()
+
+caches = {}
+
+def memoize(func=None, maxsize=1024, ttl=None):
+    if func is None:
+        return lambda func: memoize(func, maxsize, ttl)
+
+    cache = OrderedDict()
+    lock = threading.Lock()
+    info = {'hits': 0, 'misses': 0, 'evictions': 0, 'maxsize': maxsize, 'ttl': ttl}
+
+    @wraps(func)
     def decorator_memoize(*key):
         if os.environ.get('PYTEST_CURRENT_TEST'):
             return func(*key)
-        if key not in func.__dict__:
-            func.__dict__[key] = func(*key)
-        return func.__dict__[key]
+
+        now = time.monotonic()
+
+        with lock:
+            if key in cache:
+                value, expires = cache[key]
+                if expires is None or expires > now:
+                    cache.move_to_end(key)
+                    info['hits'] += 1
+                    return value
+                del cache[key]
+            info['misses'] += 1
+
+        value = func(*key)
+
+        with lock:
+            cache[key] = (value, now + ttl if ttl else None)
+            cache.move_to_end(key)
+            while len(cache) > maxsize:
+                cache.popitem(last=False)
+                info['evictions'] += 1
+
+        return value
+
+    def invalidate(*key):
+        with lock:
+            cache.pop(key, None)
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+
+    def cache_info():
+        with lock:
+            return dict(info, size=len(cache))
+
+    decorator_memoize.invalidate = invalidate
+    decorator_memoize.cache_clear = cache_clear
+    decorator_memoize.cache_info = cache_info
+
+    caches['%s.%s' % (func.__module__, func.__name__)] = decorator_memoize
+
     return decorator_memoize
 
+@register_collector
+def collect_cache_stats():
+    for name, func in caches.items():
+        info = func.cache_info()
+        yield 'mrtallyman_cache_hits_total', {'cache': name}, info['hits']
+        yield 'mrtallyman_cache_misses_total', {'cache': name}, info['misses']
+
+def get_task_executor_type():
+    if os.environ.get('PYTEST_CURRENT_TEST'):
+        return 'sync'
+    return os.environ.get('TASK_EXECUTOR', 'thread')
+
+def get_task_executor():
+    global _executor, _executor_pid, _executor_slots
+
+    if _executor_pid == os.getpid():
+        return _executor
+
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            workers = int(os.environ.get('TASK_WORKERS', 4))
+            queue_size = int(os.environ.get('TASK_QUEUE_SIZE', 100))
+
+            if get_task_executor_type() == 'process':
+                _executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='task')
+
+            _executor_slots = threading.BoundedSemaphore(workers + queue_size)
+            _executor_pid = os.getpid()
+
+            if threading.current_thread() is threading.main_thread() \
+                    and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+                signal.signal(signal.SIGTERM, handle_sigterm)
+
+    return _executor
+
+def shutdown_tasks(wait=True):
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        if _executor_pid == os.getpid():
+            _executor.shutdown(wait=wait)
+        _executor = None
+        _executor_pid = None
+
+def handle_sigterm(signum, frame):
+    # Turn SIGTERM into a normal exit so that atexit drains queued tasks.
+    raise SystemExit(128 + signum)
+
+atexit.register(shutdown_tasks)
+
+def run_timed(func, args, kwargs, submitted=None):
+    started = time.time()
+    if submitted is not None:
+        observe('mrtallyman_queue_wait_seconds', max(0, started - submitted), queue='task')
+    try:
+        return func(*args, **kwargs)
+    finally:
+        observe('mrtallyman_task_seconds', time.time() - started, task=func.__name__)
+
+def run_task(module, name, args, kwargs, submitted=None):
+    func = getattr(importlib.import_module(module), name)
+    return run_timed(func.__wrapped__, args, kwargs, submitted)
+
+def task_done(future, slots):
+    slots.release()
+
+    exc = future.exception()
+    if exc:
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
 def task(func):
+    @wraps(func)
     def decorator_task(*args, **kwargs):
-        if os.environ.get('PYTEST_CURRENT_TEST'):
-            return func(*args, **kwargs)
-        p = Process(target=func, args=args, kwargs=kwargs)
-        p.start()
+        executor_type = get_task_executor_type()
+
+        if executor_type == 'sync':
+            return run_timed(func, args, kwargs)
+
+        executor = get_task_executor()
+        slots = _executor_slots
+
+        # Backpressure: when the queue is full, wait for a slot and
+        # eventually run the task in the caller rather than drop it.
+        if not slots.acquire(timeout=float(os.environ.get('TASK_QUEUE_TIMEOUT', 1))):
+            return run_timed(func, args, kwargs)
+
+        try:
+            if executor_type == 'process':
+                future = executor.submit(run_task, func.__module__, func.__name__, args, kwargs, time.time())
+            else:
+                future = executor.submit(run_timed, func, args, kwargs, time.time())
+        except BaseException:
+            slots.release()
+            raise
+
+        future.add_done_callback(lambda future: task_done(future, slots))
     return decorator_task
@@ -0,0 +1,156 @@
+import fcntl
+import os
+import tempfile
+import threading
+import time
+
+LEADERBOARD_SIZE = 10
+
+_leaderboards = {}
+_generations = {}
+_lock = threading.Lock()
+
+def get_leaderboard_ttl():
+    return float(os.environ.get('LEADERBOARD_TTL', 60))
+
+def get_signal_dir():
+    default = os.path.join(tempfile.gettempdir(), 'mrtallyman-%s.leaderboards' % os.environ.get('MYSQL_DATABASE'))
+    return os.environ.get('LEADERBOARD_SIGNAL_DIR', default)
+
+def get_signal_path(team_id):
+    return os.path.join(get_signal_dir(), team_id)
+
+def get_scores_version(team_id):
+    try:
+        stat = os.stat(get_signal_path(team_id))
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+def signal_scores_change(team_id):
+    # Scores are also written by other workers, task processes and the
+    # reset-scores command, so every write replaces the team's signal file
+    # the same way config changes are signalled. Returns the version before
+    # and after this write, read under a lock so no other write lands
+    # between them.
+    directory = get_signal_dir()
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        previous = get_scores_version(team_id)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as signal_file:
+            signal_file.write(str(time.time()))
+            signal_file.flush()
+            stat = os.fstat(signal_file.fileno())
+        os.replace(signal_file.name, get_signal_path(team_id))
+
+    return previous, (stat.st_ino, stat.st_mtime_ns)
+
+def get_entry(team_id):
+    entry = _leaderboards.get(team_id)
+    if entry and entry['expires'] > time.monotonic() and entry['version'] == get_scores_version(team_id):
+        return entry
+    _leaderboards.pop(team_id, None)
+
+def get_cached_leaderboards(team_id, load):
+    with _lock:
+        entry = get_entry(team_id)
+        if entry:
+            return {column: list(rows) for column, rows in entry['boards'].items()}
+        generation = _generations.get(team_id, 0)
+        # Read before loading, so a write that lands during the load leaves
+        # the cached boards behind the signal and they are loaded again.
+        version = get_scores_version(team_id)
+
+    boards = load(team_id, LEADERBOARD_SIZE)
+
+    with _lock:
+        # Scores written while the boards were loading may be missing from
+        # them, so only cache boards that nothing has written past.
+        if _generations.get(team_id, 0) != generation:
+            return boards
+
+        _leaderboards[team_id] = {
+            'boards': {column: list(rows) for column, rows in boards.items()},
+            'expires': time.monotonic() + get_leaderboard_ttl(),
+            'rendered': {},
+            'version': version,
+        }
+
+    return boards
+
+def get_rendered_leaderboards(team_id, key):
+    with _lock:
+        entry = get_entry(team_id)
+        if entry:
+            return entry['rendered'].get(key)
+
+def set_rendered_leaderboards(team_id, key, text):
+    with _lock:
+        entry = get_entry(team_id)
+        if entry:
+            entry['rendered'][key] = text
+
+def bump_generation(team_id):
+    _generations[team_id] = _generations.get(team_id, 0) + 1
+
+def invalidate_leaderboards(team_id):
+    with _lock:
+        bump_generation(team_id)
+        _leaderboards.pop(team_id, None)
+        signal_scores_change(team_id)
+
+def update_board(rows, column, user_id, score):
+    # Returns False when the board can no longer be trusted because a user
+    # outside the top N may now belong in it.
+    full = len(rows) >= LEADERBOARD_SIZE
+
+    for index, row in enumerate(rows):
+        if row['user_id'] == user_id:
+            if score == row[column]:
+                return True
+            if score < row[column] and full:
+                return False
+            if score > 0:
+                rows[index] = {'user_id': user_id, column: score}
+            else:
+                del rows[index]
+            break
+    else:
+        if score <= 0 or (full and score <= rows[-1][column]):
+            return True
+        rows.append({'user_id': user_id, column: score})
+
+    rows.sort(key=lambda row: row[column], reverse=True)
+    del rows[LEADERBOARD_SIZE:]
+    return True
+
+def record_scores(team_id, users):
+    with _lock:
+        bump_generation(team_id)
+        previous, version = signal_scores_change(team_id)
+        entry = _leaderboards.get(team_id)
+        if not entry:
+            return
+        if entry['version'] != previous:
+            # Another process wrote since the boards were loaded.
+            del _leaderboards[team_id]
+            return
+        entry['version'] = version
+
+        changed = False
+
+        for user in users:
+            for column, rows in entry['boards'].items():
+                # Users may carry only the columns that changed.
+                if column not in user:
+                    continue
+                before = [dict(row) for row in rows]
+                if not update_board(rows, column, user['user_id'], user.get(column, 0)):
+                    del _leaderboards[team_id]
+                    return
+                changed = changed or rows != before
+
+        if changed:
+            entry['rendered'] = {}
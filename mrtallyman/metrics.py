@@ -0,0 +1,288 @@
+import atexit
+import fcntl
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+ARCHIVE = 'archive.json'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRICS = {
+    'mrtallyman_cache_hits_total': ('counter', 'Memoized cache hits.'),
+    'mrtallyman_cache_misses_total': ('counter', 'Memoized cache misses.'),
+    'mrtallyman_db_pool_connections': ('gauge', 'Idle connections in the database pool.'),
+    'mrtallyman_db_pool_events_total': ('counter', 'Database pool connection events.'),
+    'mrtallyman_db_pool_wait_seconds_total': ('counter', 'Time spent waiting for a database connection.'),
+    'mrtallyman_db_query_seconds': ('histogram', 'Database statement execution time, by calling function.'),
+    'mrtallyman_http_ack_seconds': ('histogram', 'Time taken to respond to a request, by endpoint.'),
+    'mrtallyman_queue_wait_seconds': ('histogram', 'Time work waited before it started, by queue.'),
+    'mrtallyman_slack_api_seconds': ('histogram', 'Slack Web API call duration, by method.'),
+    'mrtallyman_slack_rate_limited_total': ('counter', 'Slack Web API calls retried after a 429.'),
+    'mrtallyman_task_seconds': ('histogram', 'Task duration, by task.'),
+}
+
+_histograms = {}
+_counters = {}
+_collectors = []
+_lock = threading.Lock()
+_metrics_pid = None
+_last_write = 0
+
+def get_metrics_dir():
+    default = os.path.join(tempfile.gettempdir(), 'mrtallyman-%s.metrics' % os.environ.get('MYSQL_DATABASE'))
+    return os.environ.get('METRICS_DIR', default)
+
+def get_labels(labels):
+    return tuple(sorted(labels.items()))
+
+def reset_metrics():
+    global _histograms, _counters, _metrics_pid
+
+    _histograms = {}
+    _counters = {}
+    _metrics_pid = os.getpid()
+
+def check_pid():
+    # Forked workers start counting from zero rather than sharing the
+    # parent's numbers, which the parent reports itself.
+    if _metrics_pid != os.getpid():
+        reset_metrics()
+
+def observe(name, seconds, **labels):
+    key = (name, get_labels(labels))
+
+    with _lock:
+        check_pid()
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+                break
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+    write_snapshot_later()
+
+def increment(name, amount=1, **labels):
+    key = (name, get_labels(labels))
+
+    with _lock:
+        check_pid()
+        _counters[key] = _counters.get(key, 0) + amount
+
+    write_snapshot_later()
+
+@contextmanager
+def timer(name, **labels):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+def register_collector(func):
+    # Collectors return (name, labels, value) for numbers another module
+    # already keeps, such as pool and cache statistics. Each is reported as
+    # the type METRICS declares for its name.
+    _collectors.append(func)
+    return func
+
+def snapshot():
+    with _lock:
+        check_pid()
+        histograms = [[name, list(labels), dict(histogram, buckets=list(histogram['buckets']))] for (name, labels), histogram in _histograms.items()]
+        counters = [[name, list(labels), value] for (name, labels), value in _counters.items()]
+
+    gauges = []
+    for collector in _collectors:
+        for name, labels, value in collector():
+            # Collected totals such as cache hits are counters too, and have
+            # to outlive the process like the ones kept here.
+            if METRICS.get(name, ('gauge',))[0] == 'counter':
+                counters.append([name, sorted(labels.items()), value])
+            else:
+                gauges.append([name, sorted(labels.items()), value])
+
+    return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+def write_snapshot():
+    global _last_write
+
+    _last_write = time.monotonic()
+    directory = get_metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+
+    path = os.path.join(directory, '%d.json' % os.getpid())
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.%d.' % os.getpid())
+    with os.fdopen(fd, 'w') as handle:
+        json.dump(snapshot(), handle)
+    os.replace(tmp, path)
+
+def write_snapshot_later():
+    if time.monotonic() - _last_write > float(os.environ.get('METRICS_WRITE_INTERVAL', 5)):
+        try:
+            write_snapshot()
+        except OSError:
+            pass
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+@contextmanager
+def archive_lock(directory):
+    with open(os.path.join(directory, '.lock'), 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+def load_snapshot(path):
+    with open(path) as handle:
+        return json.load(handle)
+
+def archive_snapshot(path):
+    # Like prometheus_client's multiprocess mode, the counters and
+    # histograms of a process that has gone are merged into an archive so
+    # totals never go down. Its gauges go with it.
+    directory = os.path.dirname(path)
+    archive_path = os.path.join(directory, ARCHIVE)
+
+    with archive_lock(directory):
+        try:
+            data = load_snapshot(path)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            data = {}
+
+        try:
+            archive = load_snapshot(archive_path)
+        except (OSError, ValueError):
+            archive = {}
+
+        histograms, counters = aggregate([archive, {'counters': data.get('counters', []), 'histograms': data.get('histograms', [])}])
+
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.archive.')
+        with os.fdopen(fd, 'w') as handle:
+            json.dump({
+                'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+                'gauges': [],
+                'histograms': [[name, list(labels), histogram] for (name, labels), histogram in histograms.items()],
+            }, handle)
+        os.replace(tmp, archive_path)
+        os.remove(path)
+
+def read_snapshots():
+    write_snapshot()
+    directory = get_metrics_dir()
+    snapshots = []
+
+    for filename in os.listdir(directory):
+        # Only per-process files count here, not the archive or anything
+        # else left in the directory.
+        pid = filename[:-len('.json')]
+        if not filename.endswith('.json') or not pid.isdigit():
+            continue
+
+        path = os.path.join(directory, filename)
+
+        if not pid_alive(int(pid)):
+            archive_snapshot(path)
+            continue
+
+        try:
+            snapshots.append(load_snapshot(path))
+        except (OSError, ValueError):
+            continue
+
+    # Read after the loop, so processes archived above are counted.
+    try:
+        snapshots.append(load_snapshot(os.path.join(directory, ARCHIVE)))
+    except (OSError, ValueError):
+        pass
+
+    return snapshots
+
+def aggregate(snapshots):
+    histograms = {}
+    values = {}
+
+    for data in snapshots:
+        for name, labels, histogram in data.get('histograms', []):
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+            total['count'] += histogram['count']
+            total['sum'] += histogram['sum']
+
+        for name, labels, value in data.get('counters', []) + data.get('gauges', []):
+            key = (name, tuple(map(tuple, labels)))
+            values[key] = values.get(key, 0) + value
+
+    return histograms, values
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs]
+    return '{' + ','.join('%s="%s"' % pair for pair in escaped) + '}'
+
+def render(snapshots):
+    histograms, values = aggregate(snapshots)
+    lines = []
+
+    for name in sorted(set(key[0] for key in list(histograms) + list(values))):
+        kind, description = METRICS.get(name, ('untyped', ''))
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+        for key in sorted(key for key in histograms if key[0] == name):
+            histogram = histograms[key]
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, format_labels(key[1], [('le', repr(float(bound)))]), cumulative))
+            lines.append('%s_bucket%s %d' % (name, format_labels(key[1], [('le', '+Inf')]), histogram['count']))
+            lines.append('%s_sum%s %r' % (name, format_labels(key[1]), histogram['sum']))
+            lines.append('%s_count%s %d' % (name, format_labels(key[1]), histogram['count']))
+
+        for key in sorted(key for key in values if key[0] == name):
+            lines.append('%s%s %r' % (name, format_labels(key[1]), values[key]))
+
+    return '\n'.join(lines) + '\n'
+
+def valid_metrics_token(authorization):
+    token = os.environ.get('METRICS_TOKEN')
+    if not token or not authorization or not authorization.startswith('Bearer '):
+        return False
+    return hmac.compare_digest(authorization[len('Bearer '):].encode('utf-8'), token.encode('utf-8'))
+
+def render_metrics():
+    return render(read_snapshots())
+
+def close_metrics():
+    path = os.path.join(get_metrics_dir(), '%d.json' % os.getpid())
+
+    if _metrics_pid == os.getpid() and os.path.exists(path):
+        try:
+            write_snapshot()
+            archive_snapshot(path)
+        except OSError:
+            pass
+
+atexit.register(close_metrics)
@@ -0,0 +1,70 @@
+import atexit
+import os
+import threading
+import traceback
+
+from collections import OrderedDict
+
+from .slack import post_message
+
+_pending = OrderedDict()
+_pending_pid = None
+_lock = threading.Lock()
+_timer = None
+
+def get_notify_window():
+    if os.environ.get('PYTEST_CURRENT_TEST'):
+        return 0
+    return float(os.environ.get('NOTIFY_WINDOW', 5))
+
+def format_notification(emoji, count, givers):
+    senders = ', '.join('<@%s>' % giver for giver in givers)
+    if count == 1:
+        return 'You received a :%s: from %s!' % (emoji, senders)
+    return 'You received %d :%s: from %s!' % (count, emoji, senders)
+
+def notify(team_id, recipient, giver, emoji, count=1):
+    global _pending, _pending_pid, _timer
+
+    window = get_notify_window()
+
+    if window <= 0:
+        post_message(team_id, format_notification(emoji, count, [giver]), recipient)
+        return
+
+    with _lock:
+        if _pending_pid != os.getpid():
+            # Timers don't survive a fork and the parent sends its own.
+            _pending = OrderedDict()
+            _pending_pid = os.getpid()
+            _timer = None
+
+        entry = _pending.setdefault((team_id, recipient, emoji), {'count': 0, 'givers': []})
+        entry['count'] += count
+        if giver not in entry['givers']:
+            entry['givers'].append(giver)
+
+        if _timer is None:
+            _timer = threading.Timer(window, flush_notifications)
+            _timer.daemon = True
+            _timer.start()
+
+def flush_notifications():
+    global _pending, _timer
+
+    with _lock:
+        if _pending_pid != os.getpid():
+            return
+        pending = _pending
+        _pending = OrderedDict()
+        if _timer is not None:
+            _timer.cancel()
+            _timer = None
+
+    for (team_id, recipient, emoji), entry in pending.items():
+        try:
+            post_message(team_id, format_notification(emoji, entry['count'], entry['givers']), recipient)
+        except Exception:
+            traceback.print_exc()
+
+atexit.register(flush_notifications)
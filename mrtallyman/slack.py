@@ -1,17 +1,31 @@
 import hashlib
 import hmac
+import json
 import os
 import slack
+import threading
 import time
 
+from collections import OrderedDict
+from .client import AsyncWebClient
 from .decorators import memoize
+from .metrics import timer
 
 handlers = {}
+conditions = {}
 
-def on(name):
+_seen_events = OrderedDict()
+_seen_lock = threading.Lock()
+_last_purge = 0
+_signing_hmacs = {}
+
+def on(name, when=None):
     def decorator_on(func):
         global handlers
 
+        if when:
+            conditions[(func.__module__, func.__name__)] = when
+
         if name not in handlers:
             handlers[name] = []
         found = False
@@ -24,50 +38,175 @@ def on(name):
         return func
     return decorator_on
 
-@memoize
+class TimedWebClient(slack.WebClient):
+    def api_call(self, api_method, **kwargs):
+        with timer('mrtallyman_slack_api_seconds', method=api_method):
+            return super().api_call(api_method, **kwargs)
+
+def use_async_client():
+    return os.environ.get('SLACK_CLIENT') == 'async'
+
+@memoize(ttl=3600)
+def get_token_client(token):
+    if use_async_client():
+        return AsyncWebClient(token)
+    if os.environ.get('SLACK_API_URL'):
+        return TimedWebClient(token=token, base_url=os.environ['SLACK_API_URL'])
+    return TimedWebClient(token=token)
+
 def get_client(team_id):
     from .db import get_bot_access_token
     token = get_bot_access_token(team_id)
-    return slack.WebClient(token=token)
+    return get_token_client(token)
 
 def get_bot_by_token(token):
-    client = slack.WebClient(token=token)
-    return client.auth_test()
+    return get_token_client(token).auth_test()
 
 def post_message(team_id, text, channel, thread_ts=None):
-    get_client(team_id).chat_postMessage(
+    client = get_client(team_id)
+
+    if use_async_client():
+        # Nothing uses the response, so don't hold the worker while it's sent.
+        client.post_later(channel=channel, thread_ts=thread_ts, text=text)
+        return
+
+    client.chat_postMessage(
         channel=channel,
         thread_ts=thread_ts,
         text=text
     )
 
+def should_dispatch(func, payload):
+    when = conditions.get((func.__module__, func.__name__))
+    return when is None or when(payload)
+
+def get_dispatch_handlers(payload):
+    return [func for func in handlers.get(payload['event']['type'], []) if should_dispatch(func, payload)]
+
 def handle_event(payload):
-    event_type = payload['event']['type']
+    if payload['event']['type'] not in handlers:
+        return False
 
-    if event_type in handlers:
-        for func in handlers[event_type]:
-            func(payload)
-        return True
-    return False
+    for func in get_dispatch_handlers(payload):
+        func(payload)
+    return True
+
+def get_event_ttl():
+    return float(os.environ.get('EVENT_DEDUP_TTL', 3600))
+
+def is_duplicate_event(payload):
+    global _last_purge
+
+    event_id = payload.get('event_id')
+    if not event_id:
+        return False
+
+    with _seen_lock:
+        if event_id in _seen_events:
+            _seen_events.move_to_end(event_id)
+            return True
+
+    from .db import claim_event, purge_events
+
+    # The table catches retries that land on another process.
+    duplicate = not claim_event(event_id)
+
+    with _seen_lock:
+        _seen_events[event_id] = True
+        while len(_seen_events) > int(os.environ.get('EVENT_DEDUP_SIZE', 10000)):
+            _seen_events.popitem(last=False)
+
+        purge = time.monotonic() - _last_purge > 60
+        if purge:
+            _last_purge = time.monotonic()
+
+    if purge:
+        # A purge after a backlog can take a while, so it runs off the
+        # request instead of inside Slack's ack window.
+        threading.Thread(target=purge_events, args=(get_event_ttl(),), name='purge-events', daemon=True).start()
+
+    return duplicate
+
+def release_event(payload):
+    event_id = payload.get('event_id')
+    if not event_id:
+        return
+
+    with _seen_lock:
+        _seen_events.pop(event_id, None)
+
+    from .db import unclaim_event
+
+    unclaim_event(event_id)
+
+def accept_event(payload):
+    # The when= filters run before the claim, so traffic no handler wants
+    # is acked without a query. Duplicates get no handlers either.
+    funcs = get_dispatch_handlers(payload)
+    if not funcs or is_duplicate_event(payload):
+        return []
+    return funcs
+
+def dispatch_event(payload, funcs):
+    from .db import enqueue_job
+
+    # An event that fails to queue or run gives up its claim, so Slack's
+    # retry is handled instead of being acked as a duplicate.
+    try:
+        if os.environ.get('EVENT_QUEUE'):
+            enqueue_job(payload)
+        else:
+            for func in funcs:
+                func(payload)
+    except BaseException:
+        release_event(payload)
+        raise
+
+def get_max_content_length():
+    return int(os.environ.get('MAX_CONTENT_LENGTH', 1024 * 1024))
+
+def get_signing_hmac(slack_signing_secret):
+    # A plain dict: memoize's locking costs more than the HMAC setup it saves.
+    mac = _signing_hmacs.get(slack_signing_secret)
+    if mac is None:
+        mac = _signing_hmacs[slack_signing_secret] = hmac.new(slack_signing_secret.encode('utf-8'), digestmod=hashlib.sha256)
+    return mac
 
 def generate_signature(timestamp, slack_signing_secret, data):
-    key = bytes(slack_signing_secret, 'utf-8')
-    msg = ('v0:' + timestamp + ':' + data).encode('utf-8')
-    return 'v0=' + hmac.new(key, msg, hashlib.sha256).hexdigest()
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    # Copying the keyed HMAC skips hashing the key again for every request.
+    mac = get_signing_hmac(slack_signing_secret).copy()
+    mac.update(b'v0:' + timestamp.encode('ascii') + b':')
+    mac.update(data)
+    return 'v0=' + mac.hexdigest()
 
-def valid_request(app, request):
-    timestamp = request.headers['X-Slack-Request-Timestamp']
-    if abs(time.time() - float(timestamp)) > 60 * 5:
+def valid_signature(timestamp, signature, data):
+    try:
+        if abs(time.time() - float(timestamp)) > 60 * 5:
+            return False
+        expected = generate_signature(timestamp, os.environ['SLACK_SIGNING_SECRET'], data)
+    except (UnicodeEncodeError, ValueError):
         return False
-    signature = generate_signature(timestamp, os.environ['SLACK_SIGNING_SECRET'], request.get_data().decode())
-    return hmac.compare_digest(signature, request.headers['X-Slack-Signature'])
+    return hmac.compare_digest(expected, signature)
+
+def valid_request(app, request):
+    return valid_signature(request.headers['X-Slack-Request-Timestamp'],
+                           request.headers['X-Slack-Signature'],
+                           request.get_data())
 
 def handle_request(app, request):
     if valid_request(app, request):
-        payload = request.get_json()
+        # Decoding first skips json's own encoding detection.
+        payload = json.loads(request.get_data().decode('utf-8'))
 
         if payload['type'] == 'event_callback':
-            return handle_event(payload)
+            if payload['event']['type'] not in handlers:
+                return False
+            funcs = accept_event(payload)
+            if funcs:
+                dispatch_event(payload, funcs)
+            return True
         elif payload['type'] == 'url_verification':
             return payload['challenge']
     return False
@@ -1,6 +1,16 @@
+import os
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from .decorators import memoize
 from .slack import get_client, post_message
 
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
 def team_log(team_id, message, channel=None, level='debug'):
     if channel:
         post_message(team_id, message, channel)
@@ -11,9 +21,114 @@ def get_reward_emojis(team):
 def get_troll_emojis(team):
     return team['troll_emojis'].split(',')
 
+@memoize(maxsize=1024)
+def get_emoji_matcher(reward_emojis, troll_emojis):
+    emojis = [emoji for emoji in (reward_emojis or '').split(',') + (troll_emojis or '').split(',') if emoji]
+    if emojis:
+        alternatives = '|'.join(re.escape(emoji) for emoji in sorted(set(emojis), key=len, reverse=True))
+    else:
+        alternatives = '(?!)'
+    return re.compile(r':(%s):|<@([A-Z0-9]+)>' % alternatives)
+
+def match_message(team, text):
+    matcher = get_emoji_matcher(team['reward_emojis'], team['troll_emojis'])
+    reward_emojis = set(get_reward_emojis(team))
+
+    found = {
+        'mentions': [],
+        'rewards': 0,
+        'trolls': 0,
+    }
+
+    for emoji, mention in matcher.findall(text or ''):
+        if mention:
+            found['mentions'].append(mention)
+        elif emoji in reward_emojis:
+            found['rewards'] += 1
+        else:
+            found['trolls'] += 1
+
+    return found
+
+def is_scoring_message(team, text):
+    # Most messages have no emoji at all, so check that before matching.
+    if not team or not text or ':' not in text:
+        return False
+    found = match_message(team, text)
+    return bool(found['trolls'] or (found['rewards'] and found['mentions']))
+
+def is_scoring_reaction(team, event):
+    if not team or not event.get('item_user') or event['user'] == event['item_user']:
+        return False
+    return event['reaction'] in get_reward_emojis(team) or event['reaction'] in get_troll_emojis(team)
+
+def get_team_day(team):
+    tz = timezone.utc
+
+    if ZoneInfo and team.get('timezone'):
+        try:
+            tz = ZoneInfo(team['timezone'])
+        except (KeyError, ValueError):
+            pass
+
+    return datetime.now(tz).date()
+
 def get_user_name(info):
     return info['user']['profile']['display_name'] or info['user']['profile']['real_name']
 
-@memoize
+def get_user_cache_ttl():
+    return int(os.environ.get('USER_CACHE_TTL', 86400))
+
+def fetch_user_info(team_id, user_id):
+    response = get_client(team_id).users_info(user=user_id)
+    return getattr(response, 'data', response)
+
+@memoize(maxsize=10000, ttl=3600)
 def get_user_info(team_id, user_id):
-    return get_client(team_id).users_info(user=user_id)
+    return get_users_info(team_id, [user_id])[user_id]
+
+def get_users_info(team_id, user_ids):
+    from .db import get_user_profiles, save_user_profiles
+
+    user_ids = list(dict.fromkeys(user_ids))
+    ttl = get_user_cache_ttl()
+
+    if ttl:
+        infos = get_user_profiles(team_id, user_ids, ttl)
+    else:
+        infos = {}
+
+    missing = [user_id for user_id in user_ids if user_id not in infos]
+
+    if len(missing) == 1:
+        fetched = {missing[0]: fetch_user_info(team_id, missing[0])}
+    elif missing:
+        max_workers = min(len(missing), int(os.environ.get('SLACK_LOOKUP_CONCURRENCY', 8)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetched = dict(zip(missing, executor.map(lambda user_id: fetch_user_info(team_id, user_id), missing)))
+    else:
+        fetched = {}
+
+    if ttl:
+        save_user_profiles(team_id, fetched)
+
+    infos.update(fetched)
+
+    return infos
+
+def refresh_user_profiles(team_id, limit=200):
+    from .db import save_user_profiles
+
+    client = get_client(team_id)
+    cursor = None
+    count = 0
+
+    while True:
+        response = client.users_list(cursor=cursor, limit=limit)
+        members = response['members']
+        save_user_profiles(team_id, {member['id']: {'ok': True, 'user': member} for member in members})
+        count += len(members)
+
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return count
@@ -0,0 +1,67 @@
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .db import claim_jobs, complete_job, fail_job
+from .metrics import observe
+from .slack import handle_event
+
+def process_job(job, max_attempts):
+    if 'available_at' in job:
+        observe('mrtallyman_queue_wait_seconds', max(0, time.time() - job['available_at']), queue='job')
+
+    try:
+        handle_event(job['payload'])
+    except Exception:
+        fail_job(job, traceback.format_exc(), max_attempts)
+    else:
+        complete_job(job['id'])
+
+def run_worker(concurrency=4, poll_interval=1.0, lock_timeout=300, max_attempts=5, echo=print):
+    # The worker is already off the request path, so tasks run inline
+    # in the worker threads instead of being handed to another pool.
+    os.environ['TASK_EXECUTOR'] = 'sync'
+
+    worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+    stopping = threading.Event()
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def stop(signum, frame):
+        echo('Stopping worker %s after in-flight jobs' % worker_id)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def run(job):
+        try:
+            process_job(job, max_attempts)
+        finally:
+            slots.release()
+
+    echo('Worker %s started with concurrency %d' % (worker_id, concurrency))
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='worker') as executor:
+        while not stopping.is_set():
+            free = 0
+            while slots.acquire(blocking=False):
+                free += 1
+
+            jobs = claim_jobs(worker_id, free, lock_timeout) if free else []
+
+            for job in jobs:
+                executor.submit(run, job)
+            for _ in range(free - len(jobs)):
+                slots.release()
+
+            if len(jobs) < free:
+                stopping.wait(poll_interval)
+            elif not jobs:
+                time.sleep(0.01)
+
+    echo('Worker %s stopped' % worker_id)
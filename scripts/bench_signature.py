@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Measure the cost of verifying a Slack request signature.
+
+    python scripts/bench_signature.py --size 2000 --number 100000
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mrtallyman.slack import generate_signature, valid_signature
+
+SECRET = 'bench-signing-secret'
+
+def legacy_signature(timestamp, slack_signing_secret, data):
+    key = bytes(slack_signing_secret, 'utf-8')
+    msg = ('v0:' + timestamp + ':' + data).encode('utf-8')
+    return 'v0=' + hmac.new(key, msg, hashlib.sha256).hexdigest()
+
+def legacy_verify(timestamp, signature, body):
+    # What valid_request and handle_request used to do with the body.
+    if abs(time.time() - float(timestamp)) > 60 * 5:
+        return False
+    expected = legacy_signature(timestamp, os.environ['SLACK_SIGNING_SECRET'], body.decode())
+    return hmac.compare_digest(expected, signature) and json.loads(body.decode())
+
+def current_verify(timestamp, signature, body):
+    return valid_signature(timestamp, signature, body) and json.loads(body.decode('utf-8'))
+
+def make_body(size):
+    event = {
+        'type': 'message',
+        'channel': 'C0123456789',
+        'channel_type': 'channel',
+        'user': 'U0123456789',
+        'text': '',
+    }
+    payload = {'type': 'event_callback', 'team_id': 'T0123456789', 'event': event}
+    event['text'] = 'x' * max(0, size - len(json.dumps(payload)))
+    return json.dumps(payload).encode('utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2000, help='Request body size in bytes.')
+    parser.add_argument('--number', type=int, default=100000, help='Verifications per run.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs, the fastest is reported.')
+    args = parser.parse_args()
+
+    os.environ['SLACK_SIGNING_SECRET'] = SECRET
+    body = make_body(args.size)
+    timestamp = str(int(time.time()))
+    signature = generate_signature(timestamp, SECRET, body)
+
+    assert legacy_verify(timestamp, signature, body)
+    assert current_verify(timestamp, signature, body)
+
+    print('Body size: %d bytes' % len(body))
+
+    cases = [
+        ('legacy signature only', lambda: legacy_signature(timestamp, SECRET, body.decode())),
+        ('current signature only', lambda: generate_signature(timestamp, SECRET, body)),
+        ('legacy verify and parse', lambda: legacy_verify(timestamp, signature, body)),
+        ('current verify and parse', lambda: current_verify(timestamp, signature, body)),
+    ]
+
+    for name, func in cases:
+        best = min(timeit.Timer(func).repeat(repeat=args.repeat, number=args.number)) / args.number
+        print('%-26s %8.2f us/request %10.0f requests/s' % (name, best * 1e6, 1 / best))
+
+if __name__ == '__main__':
+    main()
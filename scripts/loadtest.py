@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""Replay synthetic Slack events against a running mrtallyman server.
+
+Starts a local Slack API stub, seeds the synthetic teams into MySQL, then
+sends signed event_callback requests and reports throughput, ack latency
+and end-to-end latency: until the reply reaches chat.postMessage for
+messages and mentions, and until the score is written to score_events for
+reactions.
+
+    python scripts/loadtest.py --spawn --requests 5000 --concurrency 50
+
+Without --spawn, start the app yourself with SLACK_API_URL pointing at the
+stub (http://127.0.0.1:5005/api/ by default) and the same signing secret.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mrtallyman.slack import generate_signature
+
+BOT_USER_ID = 'BLOADTEST'
+DEFAULT_MIX = 'chatter=50,message=20,reaction_added=20,reaction_removed=5,app_mention=5'
+MIX_KINDS = ['chatter', 'message', 'reaction_added', 'reaction_removed', 'app_mention']
+
+class SlackStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    replies = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or '{}')
+        else:
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+
+        method = self.path.rsplit('/', 1)[-1]
+
+        if method == 'chat.postMessage':
+            with self.lock:
+                self.replies.setdefault(params.get('channel'), time.monotonic())
+            response = {'ok': True, 'ts': '%.6f' % time.time()}
+        elif method == 'users.info':
+            user_id = params.get('user')
+            response = {'ok': True, 'user': {'id': user_id, 'name': user_id.lower(), 'is_admin': False, 'is_bot': False, 'profile': {'display_name': '', 'real_name': user_id}}}
+        elif method == 'users.list':
+            response = {'ok': True, 'members': [], 'response_metadata': {'next_cursor': ''}}
+        elif method == 'auth.test':
+            response = {'ok': True, 'team': 'Load Test', 'team_id': 'TLOAD0000', 'user_id': BOT_USER_ID}
+        else:
+            response = {'ok': True}
+
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        weights[name.strip()] = float(weight)
+    unknown = set(weights) - set(MIX_KINDS)
+    if unknown:
+        raise SystemExit('Unknown event kinds in mix: %s' % ', '.join(sorted(unknown)))
+    return weights
+
+def make_event(index, kind, args, rng):
+    team_id = 'TLOAD%04d' % rng.randrange(args.teams)
+    users = ['U%07d' % rng.randrange(args.users) for _ in range(args.mentions + 1)]
+    giver, recipients = users[0], [user for user in users[1:] if user != users[0]] or ['U%07d' % args.users]
+    # Replies and score events carry the event's channel, so a channel per
+    # event ties each of them back to the request that caused it.
+    channel = 'CLOAD%07d' % index
+    ts = '%d.%06d' % (time.time(), index % 1000000)
+    wait = None
+
+    if kind == 'chatter':
+        event = {'type': 'message', 'channel_type': 'channel', 'channel': channel, 'user': giver, 'text': 'just chatting about %d things' % index, 'ts': ts}
+    elif kind == 'message':
+        mentions = ' '.join('<@%s>' % user for user in recipients)
+        event = {'type': 'message', 'channel_type': 'channel', 'channel': channel, 'user': giver, 'text': '%s thanks! :banana:' % mentions, 'ts': ts}
+        wait = 'reply'
+    elif kind in ['reaction_added', 'reaction_removed']:
+        event = {'type': kind, 'user': giver, 'item_user': recipients[0], 'reaction': 'banana', 'item': {'type': 'message', 'channel': channel, 'ts': ts}}
+        # Reactions are scored without a reply, so they are timed until
+        # their row shows up in score_events.
+        wait = 'score'
+    else:
+        event = {'type': 'app_mention', 'channel': channel, 'user': giver, 'text': '<@%s> tally' % BOT_USER_ID, 'ts': ts}
+        wait = 'reply'
+
+    payload = {'type': 'event_callback', 'team_id': team_id, 'event_id': 'EvLOAD%09d' % index, 'event': event}
+    return payload, wait
+
+def seed_teams(args):
+    from mrtallyman.db import update_team_config
+
+    for index in range(args.teams):
+        update_team_config('TLOAD%04d' % index,
+                           team_name='Load Test %d' % index,
+                           bot_access_token='xoxb-loadtest-%d' % index,
+                           bot_user_id=BOT_USER_ID)
+
+def poll_scores(pending, batch_size=500):
+    from mrtallyman.db import db_cursor
+
+    scored = {}
+    pending = list(pending)
+
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        sql = 'SELECT `team_id`, `channel`, MIN(`created_at`) AS `created_at` FROM `score_events`' \
+            + ' WHERE (`team_id`, `channel`) IN (' + ', '.join(['(%s, %s)'] * len(batch)) + ')' \
+            + ' GROUP BY `team_id`, `channel`'
+        with db_cursor() as cursor:
+            cursor.execute(sql, [value for key in batch for value in key])
+            for row in cursor.fetchall():
+                scored[(row['team_id'], row['channel'])] = row['created_at']
+
+    return scored
+
+def spawn_app(args, stub_url):
+    env = dict(os.environ, SLACK_API_URL=stub_url, SLACK_SIGNING_SECRET=args.secret, FLASK_APP='mrtallyman')
+    port = args.target.rsplit(':', 1)[-1].strip('/')
+    if args.server == 'aio':
+        command = [sys.executable, 'aioserver.py']
+        env['PORT'] = port
+    else:
+        command = [sys.executable, '-m', 'flask', 'run', '--port', port, '--no-reload']
+
+    process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(args.target, timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+
+    process.terminate()
+    raise SystemExit('The app did not start on %s' % args.target)
+
+def percentile(values, percent):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+def report(name, values):
+    print('%-20s p50 %8.1f ms  p99 %8.1f ms  max %8.1f ms' % (
+        name,
+        percentile(values, 50) * 1000,
+        percentile(values, 99) * 1000,
+        max(values) * 1000 if values else float('nan'),
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', default='http://127.0.0.1:5000', help='Base URL of the app.')
+    parser.add_argument('--requests', type=int, default=1000, help='Number of events to send.')
+    parser.add_argument('--concurrency', type=int, default=20, help='Requests in flight at once.')
+    parser.add_argument('--rate', type=float, default=0, help='Events per second, 0 to send as fast as possible.')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Weights of each event kind.')
+    parser.add_argument('--teams', type=int, default=5, help='Number of synthetic teams.')
+    parser.add_argument('--users', type=int, default=1000, help='Number of synthetic users per team.')
+    parser.add_argument('--mentions', type=int, default=2, help='Users mentioned in each scoring message.')
+    parser.add_argument('--secret', default=os.environ.get('SLACK_SIGNING_SECRET', 'loadtest-secret'), help='Slack signing secret the app uses.')
+    parser.add_argument('--stub-port', type=int, default=5005, help='Port of the Slack API stub.')
+    parser.add_argument('--no-seed', action='store_true', help='Don\'t create the synthetic teams in MySQL.')
+    parser.add_argument('--spawn', action='store_true', help='Start the app pointed at the stub.')
+    parser.add_argument('--server', choices=['flask', 'aio'], default='flask', help='Server to start with --spawn.')
+    parser.add_argument('--drain', type=float, default=30, help='Seconds to wait for outstanding replies.')
+    parser.add_argument('--random-seed', type=int, default=0, help='Random seed for the event stream.')
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.random_seed)
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    stub = ThreadingHTTPServer(('127.0.0.1', args.stub_port), SlackStub)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = 'http://127.0.0.1:%d/api/' % args.stub_port
+    print('Slack API stub listening on %s' % stub_url)
+
+    if not args.no_seed:
+        seed_teams(args)
+
+    process = spawn_app(args, stub_url) if args.spawn else None
+
+    kinds = list(weights)
+    events = [make_event(index, kind, args, rng) for index, kind in enumerate(rng.choices(kinds, [weights[kind] for kind in kinds], k=args.requests))]
+
+    local = threading.local()
+    sent = {}
+    scoring = {}
+    scored = {}
+    acks = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def send(payload, wait, scheduled):
+        if args.rate:
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+
+        body = json.dumps(payload).encode('utf-8')
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Slack-Request-Timestamp': timestamp,
+            'X-Slack-Signature': generate_signature(timestamp, args.secret, body),
+        }
+
+        started = time.monotonic()
+        channel = payload['event'].get('channel') or payload['event'].get('item', {}).get('channel')
+        with lock:
+            if wait == 'reply':
+                sent[channel] = started
+            elif wait == 'score':
+                # score_events stores wall clock time.
+                scoring[(payload['team_id'], channel)] = time.time()
+        try:
+            status = local.session.post(args.target + '/slack/event', data=body, headers=headers, timeout=30).status_code
+        except requests.RequestException as exc:
+            status = type(exc).__name__
+        elapsed = time.monotonic() - started
+
+        with lock:
+            acks.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.monotonic()
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for index, (payload, wait) in enumerate(events):
+                executor.submit(send, payload, wait, started + index / args.rate if args.rate else 0)
+
+        duration = time.monotonic() - started
+
+        deadline = time.monotonic() + args.drain
+        while time.monotonic() < deadline:
+            scored.update(poll_scores(key for key in scoring if key not in scored))
+            with SlackStub.lock:
+                if all(channel in SlackStub.replies for channel in sent) and len(scored) == len(scoring):
+                    break
+            time.sleep(0.1)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        stub.shutdown()
+
+    end_to_end = [SlackStub.replies[channel] - at for channel, at in sent.items() if channel in SlackStub.replies]
+    reactions = [scored[key] - at for key, at in scoring.items() if key in scored]
+
+    print('Sent %d events in %.2fs (%.1f events/s) with concurrency %d' % (len(acks), duration, len(acks) / duration, args.concurrency))
+    print('Responses: %s' % ', '.join('%s=%d' % (status, count) for status, count in sorted(statuses.items(), key=str)))
+    report('Ack latency', acks)
+    report('End-to-end latency', end_to_end)
+    report('Reaction latency', reactions)
+    print('Replies received for %d of %d events that expect one' % (len(end_to_end), len(sent)))
+    print('Scores written for %d of %d reactions' % (len(reactions), len(scoring)))
+
+if __name__ == '__main__':
+    main()
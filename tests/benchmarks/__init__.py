@@ -0,0 +1,17 @@
+import random
+
+TEAM_SIZES = [100, 10000, 100000]
+MENTIONS = [1, 5, 20]
+
+def make_users(size, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            'user_id': 'U%07d' % index,
+            'rewards_received': rng.randrange(1000),
+            'rewards_given': rng.randrange(1000),
+            'trolls_received': rng.randrange(10),
+            'trolls_given': rng.randrange(10),
+        }
+        for index in range(size)
+    ]
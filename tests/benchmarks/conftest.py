@@ -0,0 +1,124 @@
+import pytest
+
+import mrtallyman
+import mrtallyman.db as db
+import mrtallyman.slack as slack
+import mrtallyman.utilities as utilities
+
+from pymysql.err import OperationalError
+
+from . import make_users
+
+try:
+    import pytest_benchmark
+except ImportError:
+    collect_ignore_glob = ['test_*.py']
+
+class StubClient:
+    def users_info(self, user):
+        return {'ok': True, 'user': {'id': user, 'name': user.lower(), 'is_admin': False, 'is_bot': False, 'profile': {'display_name': '', 'real_name': user}}}
+
+    def chat_postMessage(self, **kwargs):
+        return {'ok': True}
+
+class FakeConnection:
+    open = True
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def cursor(self):
+        return FakeCursor()
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        pass
+
+class FakeCursor:
+    def execute(self, sql, args=None):
+        return 0
+
+    def fetchone(self):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    monkeypatch.setattr(db, 'connect', FakeConnection)
+    monkeypatch.setenv('MYSQL_POOL_SIZE', '1')
+    db.reset_pool()
+
+    yield
+
+    db.reset_pool()
+
+@pytest.fixture
+def slack_stub(monkeypatch):
+    client = StubClient()
+    for module in [mrtallyman, slack, utilities]:
+        monkeypatch.setattr(module, 'get_client', lambda team_id: client)
+    return client
+
+@pytest.fixture(scope='session')
+def mysql():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    try:
+        db.connect().close()
+    except OperationalError as exc:
+        pytest.skip('MySQL is not available: %s' % exc)
+
+    db.create_tables()
+
+    yield
+
+    db.reset_pool()
+
+@pytest.fixture(scope='session')
+def seeded_teams(mysql):
+    teams = {}
+
+    def seed(size, batch_size=1000):
+        if size in teams:
+            return teams[size]
+
+        team_id = 'TBENCH%d' % size
+        db.update_team_config(team_id, team_name='Benchmark %d' % size, bot_access_token='xoxb-bench', bot_user_id='BBENCH')
+
+        with db.db_cursor() as cursor:
+            cursor.execute('DELETE FROM `team_users` WHERE `team_id` = %s', (team_id,))
+
+        users = make_users(size)
+        columns = ['user_id'] + db.SCORE_COLUMNS
+        for start in range(0, size, batch_size):
+            batch = users[start:start + batch_size]
+            sql = 'INSERT INTO `team_users` (`team_id`, ' + ', '.join('`%s`' % column for column in columns) + ') VALUES ' \
+                + ', '.join(['(%s' + ', %s' * len(columns) + ')'] * len(batch))
+            with db.db_cursor() as cursor:
+                cursor.execute(sql, [value for user in batch for value in [team_id] + [user[column] for column in columns]])
+
+        teams[size] = team_id
+        return team_id
+
+    yield seed
+
+    with db.db_cursor() as cursor:
+        for team_id in teams.values():
+            cursor.execute('DELETE FROM `team_users` WHERE `team_id` = %s', (team_id,))
+            cursor.execute('DELETE FROM `score_events` WHERE `team_id` = %s', (team_id,))
+            cursor.execute('DELETE FROM `score_rollups` WHERE `team_id` = %s', (team_id,))
+            cursor.execute('DELETE FROM `team_config` WHERE `id` = %s', (team_id,))
@@ -0,0 +1,24 @@
+import mrtallyman.db as db
+
+def test_db_cursor_overhead(benchmark, fake_db):
+    def run():
+        with db.db_cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    benchmark(run)
+
+def test_db_cursor_select(benchmark, mysql):
+    def run():
+        with db.db_cursor() as cursor:
+            cursor.execute('SELECT 1')
+            return cursor.fetchone()
+
+    assert benchmark(run)
+
+def test_db_transaction_select(benchmark, mysql):
+    def run():
+        with db.db_transaction() as cursor:
+            cursor.execute('SELECT 1')
+            return cursor.fetchone()
+
+    assert benchmark(run)
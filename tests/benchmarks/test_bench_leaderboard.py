@@ -0,0 +1,38 @@
+import pytest
+
+import mrtallyman
+import mrtallyman.db as db
+
+from mrtallyman.leaderboard import LEADERBOARD_SIZE, record_scores
+
+from . import TEAM_SIZES, make_users
+
+TEAM = {'id': 'TBENCH', 'reward_emojis': 'banana', 'troll_emojis': 'troll'}
+
+@pytest.mark.parametrize('team_size', TEAM_SIZES)
+def test_generate_leaderboard(benchmark, slack_stub, team_size):
+    users = make_users(team_size)
+
+    text = benchmark(mrtallyman.generate_leaderboard, TEAM, users)
+
+    assert len(text.splitlines()) == LEADERBOARD_SIZE
+
+@pytest.mark.parametrize('team_size', TEAM_SIZES)
+def test_get_leaderboards(benchmark, seeded_teams, team_size):
+    team_id = seeded_teams(team_size)
+
+    leaderboards = benchmark(db.get_leaderboards, team_id)
+
+    assert len(leaderboards['rewards_received']) == LEADERBOARD_SIZE
+
+def test_record_scores(benchmark, monkeypatch, tmp_path):
+    import mrtallyman.leaderboard as leaderboard
+
+    monkeypatch.setenv('LEADERBOARD_SIGNAL_DIR', str(tmp_path))
+
+    users = make_users(LEADERBOARD_SIZE * 2)
+    boards = {column: sorted(users, key=lambda user: user[column], reverse=True)[:LEADERBOARD_SIZE] for column in db.SCORE_COLUMNS}
+    monkeypatch.setattr(leaderboard, '_leaderboards', {'TBENCH': {'boards': boards, 'expires': float('inf'), 'rendered': {}, 'version': None}})
+    update = [dict(users[-1], rewards_received=users[-1]['rewards_received'] + 1)]
+
+    benchmark(record_scores, 'TBENCH', update)
@@ -0,0 +1,45 @@
+import pytest
+import random
+
+import mrtallyman
+import mrtallyman.db as db
+
+from mrtallyman.utilities import match_message
+
+from . import MENTIONS, TEAM_SIZES
+
+TEAM = {'reward_emojis': 'banana,+1', 'troll_emojis': 'troll,trollface'}
+
+@pytest.mark.parametrize('mentions', MENTIONS)
+def test_match_message(benchmark, mentions):
+    text = ' '.join('<@U%07d>' % index for index in range(mentions)) + ' you all deserve one :banana: :+1:'
+
+    found = benchmark(match_message, TEAM, text)
+
+    assert len(found['mentions']) == mentions
+
+def test_match_message_without_emoji(benchmark):
+    assert not benchmark(mrtallyman.is_scoring_message, TEAM, 'just an ordinary message with no emoji in it')
+
+@pytest.mark.parametrize('mentions', MENTIONS)
+@pytest.mark.parametrize('team_size', TEAM_SIZES)
+def test_update_users(benchmark, seeded_teams, slack_stub, team_size, mentions):
+    team_id = seeded_teams(team_size)
+    rng = random.Random(mentions)
+
+    def run():
+        recipients = ['U%07d' % index for index in rng.sample(range(1, team_size), mentions)]
+        return mrtallyman.update_users(team_id, 'CBENCH', 'U0000000', recipients)
+
+    report = benchmark(run)
+
+    assert len(report) == mentions
+
+@pytest.mark.parametrize('team_size', TEAM_SIZES)
+def test_update_team_user(benchmark, seeded_teams, team_size):
+    team_id = seeded_teams(team_size)
+    rng = random.Random(team_size)
+
+    user = benchmark(lambda: db.update_team_user(team_id, 'U%07d' % rng.randrange(team_size), 'rewards_received', 1))
+
+    assert user['rewards_received'] > 0
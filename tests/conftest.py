@@ -1,5 +1,6 @@
 import pytest
 import mrtallyman.constants as constants
+import mrtallyman.db as db
 constants.AFFIRMATIONS = ['Done.']
 
 from mrtallyman import create_app
@@ -30,3 +31,73 @@ def create_team_user(app):
 
         for user in users:
             delete_team_user(user['team_id'], user['user_id'])
+
+class FakeConnection:
+    def __init__(self):
+        self.open = True
+        self.pings = 0
+        self.executed = []
+        self.results = []
+        self.rowcounts = []
+        self.lastrowid = 0
+        self.transactions = []
+
+    def begin(self):
+        self.transactions.append('begin')
+
+    def commit(self):
+        self.transactions.append('commit')
+
+    def rollback(self):
+        self.transactions.append('rollback')
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def ping(self, reconnect=True):
+        self.pings += 1
+
+    def close(self):
+        self.open = False
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql, args=None):
+        self.connection.executed.append((' '.join(sql.split()), args))
+        if self.connection.rowcounts:
+            return self.connection.rowcounts.pop(0)
+
+    @property
+    def lastrowid(self):
+        return self.connection.lastrowid
+
+    def fetchone(self):
+        return self.connection.results.pop(0)
+
+    def fetchall(self):
+        return self.connection.results.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+@pytest.fixture
+def connections(monkeypatch):
+    connections = []
+
+    def connect():
+        connection = FakeConnection()
+        connections.append(connection)
+        return connection
+
+    monkeypatch.setattr(db, 'connect', connect)
+    monkeypatch.setenv('MYSQL_POOL_SIZE', '2')
+    db.reset_pool()
+
+    yield connections
+
+    db.reset_pool()
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import mrtallyman.aioserver as aioserver
+
+from aiohttp.test_utils import TestClient, TestServer
+from mrtallyman.slack import generate_signature
+from urllib.parse import urlencode
+
+def signed_headers(body):
+    timestamp = str(time.time())
+    return {
+        'X-Slack-Request-Timestamp': timestamp,
+        'X-Slack-Signature': generate_signature(timestamp, os.environ['SLACK_SIGNING_SECRET'], body),
+    }
+
+def post(path, body, headers=None, content_type='application/json'):
+    async def run():
+        async with TestClient(TestServer(aioserver.make_app())) as client:
+            response = await client.post(path, data=body, headers=dict(headers or signed_headers(body), **{'Content-Type': content_type}))
+            return response.status, await response.text()
+    return asyncio.run(run())
+
+def test_url_verification():
+    body = json.dumps({'type': 'url_verification', 'challenge': 'CHALLENGE'})
+
+    assert post('/slack/event', body) == (200, 'CHALLENGE')
+
+def test_invalid_signature_is_rejected():
+    body = json.dumps({'type': 'url_verification', 'challenge': 'CHALLENGE'})
+    headers = signed_headers('something else')
+
+    assert post('/slack/event', body, headers)[0] == 400
+
+def test_events_are_acked_and_handled(monkeypatch):
+    handled = threading.Event()
+    monkeypatch.setitem(aioserver.handlers, 'test_event', [lambda payload: handled.set()])
+    body = json.dumps({'type': 'event_callback', 'team_id': 'TEAM', 'event': {'type': 'test_event'}})
+
+    assert post('/slack/event', body) == (200, 'OK')
+    assert handled.wait(1)
+
+def test_unknown_events_are_rejected():
+    body = json.dumps({'type': 'event_callback', 'team_id': 'TEAM', 'event': {'type': 'unknown_event'}})
+
+    assert post('/slack/event', body)[0] == 400
+
+def test_command_ping():
+    body = urlencode({'team_id': 'TEAM', 'text': 'ping'})
+
+    assert post('/slack/command', body, content_type='application/x-www-form-urlencoded') == (200, 'Pong')
+
+def test_oversized_bodies_are_rejected(monkeypatch):
+    monkeypatch.setenv('MAX_CONTENT_LENGTH', '100')
+    body = json.dumps({'type': 'url_verification', 'challenge': 'x' * 200})
+
+    assert post('/slack/event', body)[0] == 413
+
+def test_metrics_require_token(monkeypatch, tmp_path):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    monkeypatch.setenv('METRICS_TOKEN', 'secret')
+
+    async def run(headers):
+        async with TestClient(TestServer(aioserver.make_app())) as client:
+            response = await client.get('/metrics', headers=headers)
+            return response.status, await response.text()
+
+    assert asyncio.run(run({}))[0] == 403
+
+    status, text = asyncio.run(run({'Authorization': 'Bearer secret'}))
+
+    assert status == 200
+    assert '# TYPE mrtallyman_db_pool_connections gauge' in text
+
+def test_ack_times_are_labelled_by_route(monkeypatch):
+    observed = []
+    monkeypatch.setattr(aioserver, 'observe', lambda name, seconds, **labels: observed.append(labels))
+    body = json.dumps({'type': 'url_verification', 'challenge': 'CHALLENGE'})
+
+    post('/slack/event', body)
+    post('/no/such/path', body)
+
+    assert observed == [{'endpoint': '/slack/event'}]
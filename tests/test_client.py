@@ -0,0 +1,103 @@
+import json
+import pytest
+import threading
+import time
+
+import mrtallyman.client as client
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from slack.errors import SlackApiError
+from urllib.parse import parse_qs
+
+@pytest.fixture
+def stub(monkeypatch):
+    calls = []
+    responses = []
+    bodies = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            bodies.append(parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+            calls.append((self.path, self.headers['Authorization']))
+            status, headers, body = responses.pop(0) if responses else (200, {}, {'ok': True})
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body if isinstance(body, bytes) else json.dumps(body).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('SLACK_API_URL', 'http://127.0.0.1:%d/api/' % server.server_port)
+    yield calls, responses, bodies
+    server.shutdown()
+
+def test_method_names_map_to_api_methods(stub):
+    calls, responses, bodies = stub
+
+    response = client.AsyncWebClient('xoxb-1').chat_postMessage(channel='C1', text='hi', thread_ts=None)
+
+    assert response == {'ok': True}
+    assert calls == [('/api/chat.postMessage', 'Bearer xoxb-1')]
+
+def test_structured_arguments_are_sent_as_json(stub):
+    calls, responses, bodies = stub
+    dialog = {'callback_id': 'config', 'elements': [{'type': 'text', 'name': 'daily_quota'}]}
+
+    client.AsyncWebClient('xoxb-5').dialog_open(trigger_id='T1', dialog=dialog)
+
+    assert calls == [('/api/dialog.open', 'Bearer xoxb-5')]
+    assert bodies[0]['trigger_id'] == ['T1']
+    assert json.loads(bodies[0]['dialog'][0]) == dialog
+
+def test_rate_limited_requests_are_retried_after_delay(stub):
+    calls, responses, bodies = stub
+    responses.append((429, {'Retry-After': '0.2'}, {'ok': False, 'error': 'ratelimited'}))
+
+    started = time.monotonic()
+    client.AsyncWebClient('xoxb-2').users_info(user='U1')
+
+    assert len(calls) == 2
+    assert time.monotonic() - started >= 0.2
+
+def test_errors_raise_slack_api_error(stub):
+    calls, responses, bodies = stub
+    responses.append((200, {}, {'ok': False, 'error': 'user_not_found'}))
+
+    with pytest.raises(SlackApiError):
+        client.AsyncWebClient('xoxb-3').users_info(user='U1')
+
+def test_non_json_responses_raise_slack_api_error(stub):
+    calls, responses, bodies = stub
+    responses.append((502, {'Content-Type': 'text/html'}, b'<html>Bad Gateway</html>'))
+
+    with pytest.raises(SlackApiError) as excinfo:
+        client.AsyncWebClient('xoxb-6').users_info(user='U1')
+
+    assert excinfo.value.response == {'ok': False, 'error': 'http_502'}
+
+def test_requests_run_concurrently(stub):
+    calls, responses, bodies = stub
+    web_client = client.AsyncWebClient('xoxb-4')
+
+    futures = [web_client.submit('dialog.open', trigger_id=str(index)) for index in range(5)]
+
+    assert [future.result(timeout=5) for future in futures] == [{'ok': True}] * 5
+    assert len(calls) == 5
+
+def test_token_bucket_waits_for_tokens():
+    import asyncio
+
+    bucket = client.TokenBucket(rate=20, capacity=1)
+
+    async def acquire_twice():
+        await bucket.acquire()
+        await bucket.acquire()
+
+    started = time.monotonic()
+    asyncio.run(acquire_twice())
+
+    assert time.monotonic() - started >= 0.04
@@ -0,0 +1,333 @@
+import pytest
+
+import mrtallyman.db as db
+
+from pymysql.err import OperationalError
+
+def test_pool_reuses_connections(connections):
+    with db.db_cursor():
+        pass
+    with db.db_cursor():
+        pass
+
+    assert len(connections) == 1
+    assert db.get_pool_stats()['idle'] == 1
+
+def test_pool_recycles_old_connections(monkeypatch, connections):
+    monkeypatch.setenv('MYSQL_POOL_RECYCLE', '-1')
+
+    with db.db_cursor():
+        pass
+    with db.db_cursor():
+        pass
+
+    assert len(connections) == 2
+    assert not connections[0].open
+
+def test_pool_pings_idle_connections(monkeypatch, connections):
+    monkeypatch.setenv('MYSQL_POOL_PING_AFTER', '-1')
+
+    with db.db_cursor():
+        pass
+    with db.db_cursor():
+        pass
+
+    assert connections[0].pings == 1
+
+def test_pool_discards_broken_connections(connections):
+    with pytest.raises(OperationalError):
+        with db.db_cursor():
+            raise OperationalError(2006, 'MySQL server has gone away')
+
+    with db.db_cursor():
+        pass
+
+    assert len(connections) == 2
+    assert not connections[0].open
+
+def test_pool_times_out_when_exhausted(monkeypatch, connections):
+    monkeypatch.setenv('MYSQL_POOL_TIMEOUT', '0.01')
+
+    with db.db_cursor():
+        with db.db_cursor():
+            with pytest.raises(OperationalError):
+                with db.db_cursor():
+                    pass
+
+def test_pool_is_reset_after_fork(monkeypatch, connections):
+    with db.db_cursor():
+        pass
+
+    monkeypatch.setattr(db, '_pool_pid', -1)
+
+    with db.db_cursor():
+        pass
+
+    assert len(connections) == 2
+    assert connections[0].open
+
+def test_transaction_commits(connections):
+    with db.db_transaction():
+        pass
+
+    assert connections[0].transactions == ['begin', 'commit']
+
+def test_transaction_rolls_back(connections):
+    with pytest.raises(ValueError):
+        with db.db_transaction():
+            raise ValueError()
+
+    assert connections[0].transactions == ['begin', 'rollback']
+
+def test_update_team_user_upserts(connections):
+    with db.db_cursor():
+        pass
+    connections[0].rowcounts.append(2)
+    connections[0].lastrowid = 4
+
+    user = db.update_team_user('TEAM', 'USER', 'rewards_received', -1)
+
+    assert user == {'team_id': 'TEAM', 'user_id': 'USER', 'rewards_received': 4}
+    assert connections[0].executed == [(
+        'INSERT INTO `team_users` (`team_id`, `user_id`, `rewards_received`)'
+        ' VALUES (%s, %s, GREATEST(0, %s))'
+        ' ON DUPLICATE KEY UPDATE `rewards_received` = LAST_INSERT_ID(GREATEST(0, `rewards_received` + %s))',
+        ('TEAM', 'USER', -1, -1),
+    )]
+    assert connections[0].transactions == []
+
+def test_update_team_user_creates_missing_users(connections):
+    with db.db_cursor():
+        pass
+    connections[0].rowcounts.append(1)
+
+    assert db.update_team_user('TEAM', 'USER', 'rewards_received', -1)['rewards_received'] == 0
+
+def test_update_team_users_batches_scores(connections):
+    with db.db_cursor():
+        pass
+    connections[0].results.append([
+        {'user_id': 'GIVER', 'rewards_given': 2},
+        {'user_id': 'ONE', 'rewards_received': 1},
+        {'user_id': 'TWO', 'rewards_received': 1},
+    ])
+
+    users = db.update_team_users('TEAM', {
+        'TWO': {'rewards_received': 1},
+        'ONE': {'rewards_received': 1},
+        'GIVER': {'rewards_given': 2},
+    })
+
+    assert sorted(users.keys()) == ['GIVER', 'ONE', 'TWO']
+    assert len(connections[0].executed) == 3
+    assert connections[0].executed[1] == (
+        'UPDATE `team_users` SET'
+        ' `rewards_given` = GREATEST(0, `rewards_given` + CASE `user_id` WHEN %s THEN %s ELSE 0 END),'
+        ' `rewards_received` = GREATEST(0, `rewards_received` + CASE `user_id` WHEN %s THEN %s WHEN %s THEN %s ELSE 0 END)'
+        ' WHERE `team_id` = %s AND `user_id` IN (%s, %s, %s)',
+        ['GIVER', 2, 'ONE', 1, 'TWO', 1, 'TEAM', 'GIVER', 'ONE', 'TWO'],
+    )
+
+def test_team_config_is_cached_until_changed(monkeypatch, tmp_path):
+    loaded = []
+
+    def load_team_config(team_id):
+        loaded.append(team_id)
+        return {'id': team_id}
+
+    monkeypatch.delenv('PYTEST_CURRENT_TEST')
+    monkeypatch.setenv('CONFIG_SIGNAL_PATH', str(tmp_path / 'config'))
+    monkeypatch.setattr(db, 'load_team_config', load_team_config)
+    db.get_versioned_team_config.cache_clear()
+
+    db.get_team_config('TEAM')
+    db.get_team_config('TEAM')
+    assert loaded == ['TEAM']
+
+    db.signal_config_change()
+    version = db.get_config_version()
+    db.get_team_config('TEAM')
+    assert loaded == ['TEAM', 'TEAM']
+
+    db.signal_config_change()
+    assert db.get_config_version() != version
+
+def test_get_leaderboards_selects_top_n(connections):
+    with db.db_cursor():
+        pass
+    connections[0].results.append([
+        {'board': 'rewards_received', 'user_id': 'TWO', 'score': 1},
+        {'board': 'trolls_received', 'user_id': 'TWO', 'score': 2},
+        {'board': 'rewards_received', 'user_id': 'ONE', 'score': 3},
+    ])
+
+    leaderboards = db.get_leaderboards('TEAM', ['rewards_received', 'trolls_received'], 5)
+
+    assert leaderboards == {
+        'rewards_received': [{'user_id': 'ONE', 'rewards_received': 3}, {'user_id': 'TWO', 'rewards_received': 1}],
+        'trolls_received': [{'user_id': 'TWO', 'trolls_received': 2}],
+    }
+    sql, args = connections[0].executed[0]
+    assert sql.count('ORDER BY') == 2
+    assert args == ['rewards_received', 'TEAM', 5, 'trolls_received', 'TEAM', 5]
+
+def test_migrate_team_table_adds_legacy_scores(connections):
+    with db.db_cursor():
+        pass
+    connections[0].results.extend([
+        None,
+        [{'id': 7, 'team_id': 'TEAM', 'user_id': 'USER', 'rewards_given': 1, 'rewards_given_today': 0,
+          'rewards_received': 2, 'trolls_given': 0, 'trolls_given_today': 0, 'trolls_received': 3}],
+    ])
+
+    assert db.migrate_team_table('team_TEAM', batch_size=10) == 1
+
+    statements = [sql for sql, args in connections[0].executed]
+    assert statements[3].startswith('INSERT INTO `team_users`')
+    assert '`rewards_received` = `rewards_received` + VALUES(`rewards_received`)' in statements[3]
+    assert connections[0].executed[4] == ('UPDATE `schema_migrations` SET `last_id` = %s WHERE `table_name` = %s', (7, 'team_TEAM'))
+    assert connections[0].executed[5] == ('UPDATE `schema_migrations` SET `done` = 1 WHERE `table_name` = %s', ('team_TEAM',))
+    assert connections[0].transactions == ['begin', 'commit']
+
+def test_reset_rows_chunks_by_primary_key(connections):
+    with db.db_cursor():
+        pass
+    connections[0].results.extend([None, {'team_id': 'ONE', 'user_id': 'U2'}, None])
+    connections[0].rowcounts.extend([0, 1, 2, 1, 0, 1])
+
+    result = db.reset_rows(db.SCORE_RESET, '`c`.`reset_interval` = %s', ['daily'], 'run', chunk_size=2)
+
+    assert result['rows'] == 3
+    assert result['skipped'] is False
+    updates = [(sql, args) for sql, args in connections[0].executed if sql.startswith('UPDATE `team_users`')]
+    assert 'LIMIT' not in updates[0][0]
+    assert updates[0][1] == ['daily', '', '', 'ONE', 'U2']
+    assert updates[1][1] == ['daily', 'ONE', 'U2']
+    checkpoints = [args for sql, args in connections[0].executed if sql.startswith('INSERT INTO `maintenance_runs`')]
+    assert checkpoints[0][:4] == ('run', 'ONE', 'U2', 2)
+    assert checkpoints[0][4] is None
+    assert checkpoints[1][:4] == ('run', 'ONE', 'U2', 3)
+    assert checkpoints[1][4] is not None
+    assert connections[0].transactions == ['begin', 'commit', 'begin', 'commit']
+
+def test_reset_rows_resumes_and_skips_finished_runs(connections):
+    with db.db_cursor():
+        pass
+    connections[0].results.extend([
+        {'last_team_id': 'ONE', 'last_user_id': 'U2', 'rows': 5, 'finished_at': None},
+        None,
+        {'last_team_id': 'TWO', 'last_user_id': 'U9', 'rows': 6, 'finished_at': 1.0},
+    ])
+    connections[0].rowcounts.extend([1, 0, 1])
+
+    assert db.reset_rows(db.SCORE_RESET, '`c`.`reset_interval` = %s', ['daily'], 'run')['rows'] == 6
+
+    bounds = [args for sql, args in connections[0].executed if sql.startswith('SELECT `u`.`team_id`')]
+    assert bounds == [['daily', 'ONE', 'U2', 999]]
+
+    assert db.reset_rows(db.SCORE_RESET, '`c`.`reset_interval` = %s', ['daily'], 'run') == {'duration': pytest.approx(0, abs=1), 'rows': 6, 'skipped': True}
+
+def test_update_team_users_stops_at_quota(connections):
+    with db.db_cursor():
+        pass
+    connections[0].results.append({'used': 2})
+
+    quota = {'user_id': 'GIVER', 'column': 'rewards_given_today', 'amount': 2, 'limit': 3, 'day': '2026-10-18'}
+    with pytest.raises(db.QuotaExceeded) as exc:
+        db.update_team_users('TEAM', {'ONE': {'rewards_received': 1}, 'GIVER': {'rewards_given': 2}}, quota=quota)
+
+    assert exc.value.remaining == 1
+    assert len(connections[0].executed) == 3
+    sql, args = connections[0].executed[1]
+    assert sql == (
+        'UPDATE `team_users` SET `rewards_given_today` = IF(`quota_day` = %s, `rewards_given_today`, 0) + %s, `quota_day` = %s'
+        ' WHERE `team_id` = %s AND `user_id` = %s AND (%s = 0 OR IF(`quota_day` = %s, `rewards_given_today`, 0) + %s <= %s)'
+    )
+    assert args == ('2026-10-18', 2, '2026-10-18', 'TEAM', 'GIVER', 3, '2026-10-18', 2, 3)
+    assert connections[0].transactions == ['begin', 'rollback']
+
+def test_update_team_users_refunds_quota_on_removal(connections):
+    from datetime import date
+
+    with db.db_cursor():
+        pass
+    # The counter is already at zero, so pymysql reports no changed rows.
+    connections[0].rowcounts.extend([0, 1, 0, 0])
+    connections[0].results.extend([{'day': date(2026, 10, 18)}, []])
+
+    quota = {'user_id': 'GIVER', 'column': 'rewards_given_today', 'amount': -1, 'limit': 0, 'day': date(2026, 10, 18)}
+    events = [{'giver': 'GIVER', 'recipient': 'ONE', 'kind': 'reward', 'delta': -1, 'channel': 'CHANNEL', 'message_ts': '1.2'}]
+    db.update_team_users('TEAM', {'ONE': {'rewards_received': -1}, 'GIVER': {'rewards_given': -1}}, quota=quota, events=events, day=date(2026, 10, 18))
+
+    refunds = [args for sql, args in connections[0].executed if sql.startswith('UPDATE `team_users` SET `rewards_given_today`')]
+    assert refunds == [(1, 'TEAM', 'GIVER', date(2026, 10, 18))]
+    assert connections[0].transactions == ['begin', 'commit']
+
+def test_removing_an_older_reward_refunds_nothing(connections):
+    from datetime import date
+
+    with db.db_cursor():
+        pass
+    connections[0].results.extend([{'day': date(2026, 10, 17)}, []])
+
+    quota = {'user_id': 'GIVER', 'column': 'rewards_given_today', 'amount': -1, 'limit': 3, 'day': date(2026, 10, 18)}
+    events = [{'giver': 'GIVER', 'recipient': 'ONE', 'kind': 'reward', 'delta': -1, 'channel': 'CHANNEL', 'message_ts': '1.2'}]
+    db.update_team_users('TEAM', {'ONE': {'rewards_received': -1}, 'GIVER': {'rewards_given': -1}}, quota=quota, events=events, day=date(2026, 10, 18))
+
+    assert not any(sql.startswith('UPDATE `team_users` SET `rewards_given_today`') for sql, args in connections[0].executed)
+    assert connections[0].transactions == ['begin', 'commit']
+
+def test_update_team_users_records_events_and_rollups(connections):
+    from datetime import date
+
+    with db.db_cursor():
+        pass
+    connections[0].results.append([])
+
+    events = [{'giver': 'GIVER', 'recipient': 'ONE', 'kind': 'reward', 'delta': 2, 'channel': 'CHANNEL', 'message_ts': '1.2'}]
+    db.update_team_users('TEAM', {'ONE': {'rewards_received': 2}, 'GIVER': {'rewards_given': 2}}, events=events, day=date(2026, 10, 15))
+
+    statements = [sql for sql, args in connections[0].executed]
+    assert statements[2].startswith('INSERT INTO `score_events`')
+    assert statements[3].startswith('INSERT INTO `score_rollups`')
+
+    rows = connections[0].executed[3][1]
+    rows = [tuple(rows[index:index + 6]) for index in range(0, len(rows), 6)]
+    assert ('TEAM', 'week', date(2026, 10, 12), 'rewards_received', 'ONE', 2) in rows
+    assert ('TEAM', 'month', date(2026, 10, 1), 'rewards_given', 'GIVER', 2) in rows
+    assert len(rows) == 6
+
+def test_removals_come_off_the_original_rollups(connections):
+    from datetime import date
+
+    with db.db_cursor():
+        pass
+    connections[0].results.extend([{'day': date(2026, 9, 30)}, []])
+
+    events = [{'giver': 'GIVER', 'recipient': 'ONE', 'kind': 'reward', 'delta': -1, 'channel': 'CHANNEL', 'message_ts': '1.2'}]
+    db.update_team_users('TEAM', {'ONE': {'rewards_received': -1}, 'GIVER': {'rewards_given': -1}}, events=events, day=date(2026, 10, 15))
+
+    statements = [sql for sql, args in connections[0].executed]
+    assert statements[1].startswith('SELECT `day` FROM `score_events`')
+    assert connections[0].executed[1][1] == ('TEAM', 'CHANNEL', '1.2', 'GIVER', 'ONE', 'reward')
+    assert statements[4].endswith('`total` = GREATEST(0, `total` + VALUES(`total`))')
+
+    rows = connections[0].executed[4][1]
+    rows = [tuple(rows[index:index + 6]) for index in range(0, len(rows), 6)]
+    assert ('TEAM', 'day', date(2026, 9, 30), 'rewards_received', 'ONE', -1) in rows
+    assert ('TEAM', 'month', date(2026, 9, 1), 'rewards_given', 'GIVER', -1) in rows
+    assert len(rows) == 6
+
+def test_get_period_leaderboards_reads_rollups(connections):
+    from datetime import date
+
+    with db.db_cursor():
+        pass
+    connections[0].results.append([{'board': 'rewards_received', 'user_id': 'ONE', 'score': 4}])
+
+    leaderboards = db.get_period_leaderboards('TEAM', 'week', date(2026, 10, 12), ['rewards_received', 'trolls_received'], 3)
+
+    assert leaderboards == {'rewards_received': [{'user_id': 'ONE', 'rewards_received': 4}], 'trolls_received': []}
+    sql, args = connections[0].executed[0]
+    assert 'FROM `score_rollups`' in sql
+    assert args == ['TEAM', 'week', date(2026, 10, 12), 'rewards_received', 3, 'TEAM', 'week', date(2026, 10, 12), 'trolls_received', 3]
@@ -0,0 +1,106 @@
+import threading
+
+import mrtallyman.decorators as decorators
+
+from mrtallyman.decorators import shutdown_tasks, task
+
+calls = []
+
+@task
+def record(value):
+    calls.append((value, threading.current_thread().name))
+
+def test_task_runs_inline_under_pytest():
+    calls.clear()
+    record('sync')
+    assert calls == [('sync', threading.current_thread().name)]
+
+def test_task_runs_on_thread_pool(monkeypatch):
+    monkeypatch.delenv('PYTEST_CURRENT_TEST')
+    monkeypatch.setenv('TASK_EXECUTOR', 'thread')
+    calls.clear()
+
+    for value in range(5):
+        record(value)
+    shutdown_tasks()
+
+    assert sorted(value for value, name in calls) == list(range(5))
+    assert all(name.startswith('task') for value, name in calls)
+
+def test_task_runs_inline_when_queue_is_full(monkeypatch):
+    monkeypatch.delenv('PYTEST_CURRENT_TEST')
+    monkeypatch.setenv('TASK_EXECUTOR', 'thread')
+    monkeypatch.setenv('TASK_WORKERS', '1')
+    monkeypatch.setenv('TASK_QUEUE_SIZE', '0')
+    monkeypatch.setenv('TASK_QUEUE_TIMEOUT', '0')
+    calls.clear()
+
+    release = threading.Event()
+
+    @task
+    def block():
+        release.wait()
+
+    block()
+    record('inline')
+    release.set()
+    shutdown_tasks()
+
+    assert calls == [('inline', threading.current_thread().name)]
+
+def test_run_task_calls_undecorated_function():
+    calls.clear()
+    decorators.run_task(__name__, 'record', ('process',), {})
+    assert calls == [('process', threading.current_thread().name)]
+
+def test_memoize_evicts_least_recently_used(monkeypatch):
+    monkeypatch.delenv('PYTEST_CURRENT_TEST')
+    computed = []
+
+    @decorators.memoize(maxsize=2)
+    def square(value):
+        computed.append(value)
+        return value * value
+
+    square(1)
+    square(2)
+    square(1)
+    square(3)
+    square(1)
+    square(2)
+
+    assert computed == [1, 2, 3, 2]
+    assert square.cache_info()['hits'] == 2
+    assert square.cache_info()['evictions'] == 2
+    assert square.cache_info()['size'] == 2
+
+def test_memoize_expires_entries(monkeypatch):
+    monkeypatch.delenv('PYTEST_CURRENT_TEST')
+    computed = []
+
+    @decorators.memoize(ttl=-1)
+    def square(value):
+        computed.append(value)
+        return value * value
+
+    square(1)
+    square(1)
+
+    assert computed == [1, 1]
+
+def test_memoize_invalidates_entries(monkeypatch):
+    monkeypatch.delenv('PYTEST_CURRENT_TEST')
+    computed = []
+
+    @decorators.memoize
+    def square(value):
+        computed.append(value)
+        return value * value
+
+    square(1)
+    square(2)
+    square.invalidate(1)
+    square(1)
+    square(2)
+
+    assert computed == [1, 2, 1]
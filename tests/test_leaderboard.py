@@ -0,0 +1,85 @@
+import pytest
+
+import mrtallyman.leaderboard as leaderboard
+
+@pytest.fixture
+def load(monkeypatch, tmp_path):
+    monkeypatch.setattr(leaderboard, 'LEADERBOARD_SIZE', 2)
+    monkeypatch.setenv('LEADERBOARD_SIGNAL_DIR', str(tmp_path))
+    calls = []
+
+    def load(team_id, limit):
+        calls.append(team_id)
+        return {'rewards_received': [
+            {'user_id': 'ONE', 'rewards_received': 5},
+            {'user_id': 'TWO', 'rewards_received': 3},
+        ]}
+
+    load.calls = calls
+    leaderboard.invalidate_leaderboards('TEAM')
+    yield load
+    leaderboard.invalidate_leaderboards('TEAM')
+
+def test_leaderboards_are_cached(load):
+    leaderboard.get_cached_leaderboards('TEAM', load)
+    leaderboard.get_cached_leaderboards('TEAM', load)
+    assert load.calls == ['TEAM']
+
+def test_leaderboards_are_updated_incrementally(load):
+    leaderboard.get_cached_leaderboards('TEAM', load)
+    leaderboard.set_rendered_leaderboards('TEAM', 'key', 'text')
+
+    leaderboard.record_scores('TEAM', [{'user_id': 'THREE', 'rewards_received': 4}])
+
+    boards = leaderboard.get_cached_leaderboards('TEAM', load)
+    assert boards['rewards_received'] == [
+        {'user_id': 'ONE', 'rewards_received': 5},
+        {'user_id': 'THREE', 'rewards_received': 4},
+    ]
+    assert leaderboard.get_rendered_leaderboards('TEAM', 'key') is None
+    assert load.calls == ['TEAM']
+
+def test_leaderboards_ignore_scores_outside_the_top(load):
+    leaderboard.get_cached_leaderboards('TEAM', load)
+    leaderboard.set_rendered_leaderboards('TEAM', 'key', 'text')
+
+    leaderboard.record_scores('TEAM', [{'user_id': 'THREE', 'rewards_received': 1}])
+
+    assert leaderboard.get_rendered_leaderboards('TEAM', 'key') == 'text'
+
+def test_leaderboards_reload_when_a_leader_drops(load):
+    leaderboard.get_cached_leaderboards('TEAM', load)
+
+    leaderboard.record_scores('TEAM', [{'user_id': 'TWO', 'rewards_received': 2}])
+    leaderboard.get_cached_leaderboards('TEAM', load)
+
+    assert load.calls == ['TEAM', 'TEAM']
+
+def test_boards_loaded_during_a_write_are_not_cached(load):
+    def racing_load(team_id, limit):
+        boards = load(team_id, limit)
+        leaderboard.record_scores('TEAM', [{'user_id': 'THREE', 'rewards_received': 4}])
+        return boards
+
+    leaderboard.get_cached_leaderboards('TEAM', racing_load)
+    leaderboard.get_cached_leaderboards('TEAM', load)
+
+    assert load.calls == ['TEAM', 'TEAM']
+
+def test_leaderboards_reload_after_a_write_in_another_process(load):
+    leaderboard.get_cached_leaderboards('TEAM', load)
+
+    # Other processes only share the signal file.
+    leaderboard.signal_scores_change('TEAM')
+    leaderboard.get_cached_leaderboards('TEAM', load)
+
+    assert load.calls == ['TEAM', 'TEAM']
+
+def test_scores_written_after_another_process_drop_the_boards(load):
+    leaderboard.get_cached_leaderboards('TEAM', load)
+
+    leaderboard.signal_scores_change('TEAM')
+    leaderboard.record_scores('TEAM', [{'user_id': 'THREE', 'rewards_received': 4}])
+    leaderboard.get_cached_leaderboards('TEAM', load)
+
+    assert load.calls == ['TEAM', 'TEAM']
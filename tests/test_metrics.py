@@ -0,0 +1,115 @@
+import json
+
+import mrtallyman.db as db
+import mrtallyman.decorators as decorators
+import mrtallyman.metrics as metrics
+
+class Cache:
+    def __init__(self, hits, misses):
+        self.info = {'hits': hits, 'misses': misses}
+
+    def cache_info(self):
+        return self.info
+
+def test_render_histograms_and_counters(monkeypatch):
+    monkeypatch.setattr(metrics, '_collectors', [])
+    metrics.reset_metrics()
+
+    metrics.observe('mrtallyman_task_seconds', 0.003, task='update_scores_message')
+    metrics.observe('mrtallyman_task_seconds', 2, task='update_scores_message')
+    metrics.increment('mrtallyman_slack_rate_limited_total', method='users.info')
+
+    text = metrics.render([metrics.snapshot()])
+
+    assert '# TYPE mrtallyman_task_seconds histogram' in text
+    assert 'mrtallyman_task_seconds_bucket{task="update_scores_message",le="0.005"} 1' in text
+    assert 'mrtallyman_task_seconds_bucket{task="update_scores_message",le="2.5"} 2' in text
+    assert 'mrtallyman_task_seconds_bucket{task="update_scores_message",le="+Inf"} 2' in text
+    assert 'mrtallyman_task_seconds_count{task="update_scores_message"} 2' in text
+    assert 'mrtallyman_slack_rate_limited_total{method="users.info"} 1' in text
+
+def test_snapshots_are_aggregated(monkeypatch):
+    monkeypatch.setattr(metrics, '_collectors', [lambda: [('mrtallyman_db_pool_connections', {}, 2)]])
+    metrics.reset_metrics()
+    metrics.increment('mrtallyman_cache_hits_total', 3, cache='db.get_team_config')
+    metrics.observe('mrtallyman_http_ack_seconds', 0.01, endpoint='event')
+
+    snapshot = metrics.snapshot()
+    text = metrics.render([snapshot, snapshot])
+
+    assert 'mrtallyman_cache_hits_total{cache="db.get_team_config"} 6' in text
+    assert 'mrtallyman_db_pool_connections 4' in text
+    assert 'mrtallyman_http_ack_seconds_count{endpoint="event"} 2' in text
+
+def test_snapshot_files_are_read_back(monkeypatch, tmp_path):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_collectors', [])
+    metrics.reset_metrics()
+    metrics.increment('mrtallyman_slack_rate_limited_total', method='chat.postMessage')
+    (tmp_path / '999999999.json').write_text('{}')
+    (tmp_path / 'other.json').write_text('{}')
+
+    assert 'mrtallyman_slack_rate_limited_total{method="chat.postMessage"} 1' in metrics.render_metrics()
+    assert not (tmp_path / '999999999.json').exists()
+
+def test_counters_of_dead_processes_are_kept(monkeypatch, tmp_path):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_collectors', [lambda: [('mrtallyman_db_pool_connections', {}, 2)]])
+    metrics.reset_metrics()
+    metrics.increment('mrtallyman_cache_hits_total', 3, cache='db.get_team_config')
+    metrics.observe('mrtallyman_task_seconds', 0.01, task='update_scores_message')
+    dead = metrics.snapshot()
+    (tmp_path / '999999999.json').write_text(json.dumps(dead))
+    (tmp_path / '999999998.json').write_text(json.dumps(dead))
+
+    metrics.reset_metrics()
+    text = metrics.render_metrics()
+
+    assert 'mrtallyman_cache_hits_total{cache="db.get_team_config"} 6' in text
+    assert 'mrtallyman_task_seconds_count{task="update_scores_message"} 2' in text
+    assert 'mrtallyman_db_pool_connections 2' in text
+    assert text == metrics.render_metrics()
+
+def test_collected_counters_of_dead_processes_are_kept(monkeypatch, tmp_path):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_collectors', [db.collect_pool_stats, decorators.collect_cache_stats])
+    monkeypatch.setattr(decorators, 'caches', {'db.get_team_config': Cache(hits=3, misses=1)})
+    monkeypatch.setattr(db, 'get_pool_stats', lambda: {'idle': 2, 'acquired': 5, 'created': 1, 'discarded': 0, 'recycled': 0, 'wait_total': 0.5})
+    metrics.reset_metrics()
+    (tmp_path / '999999999.json').write_text(json.dumps(metrics.snapshot()))
+
+    monkeypatch.setattr(metrics, '_collectors', [])
+    text = metrics.render_metrics()
+
+    assert 'mrtallyman_cache_hits_total{cache="db.get_team_config"} 3' in text
+    assert 'mrtallyman_cache_misses_total{cache="db.get_team_config"} 1' in text
+    assert 'mrtallyman_db_pool_events_total{event="acquired"} 5' in text
+    assert 'mrtallyman_db_pool_wait_seconds_total 0.5' in text
+    assert 'mrtallyman_db_pool_connections' not in text
+
+def test_valid_metrics_token(monkeypatch):
+    assert not metrics.valid_metrics_token('Bearer secret')
+
+    monkeypatch.setenv('METRICS_TOKEN', 'secret')
+
+    assert metrics.valid_metrics_token('Bearer secret')
+    assert not metrics.valid_metrics_token('Bearer wrong')
+    assert not metrics.valid_metrics_token(None)
+
+def test_db_queries_are_timed_by_function(connections):
+    metrics.reset_metrics()
+
+    def load_things():
+        with db.db_cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    def save_things():
+        with db.db_transaction() as cursor:
+            cursor.execute('UPDATE things')
+            cursor.execute('UPDATE other_things')
+
+    load_things()
+    save_things()
+
+    assert metrics._histograms[('mrtallyman_db_query_seconds', (('function', 'load_things'),))]['count'] == 1
+    assert metrics._histograms[('mrtallyman_db_query_seconds', (('function', 'save_things'),))]['count'] == 2
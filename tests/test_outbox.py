@@ -0,0 +1,34 @@
+import mrtallyman.outbox as outbox
+
+def test_notifications_are_coalesced_per_recipient(monkeypatch):
+    sent = []
+
+    monkeypatch.setattr(outbox, 'get_notify_window', lambda: 60)
+    monkeypatch.setattr(outbox, 'post_message', lambda team_id, text, channel: sent.append((team_id, channel, text)))
+
+    outbox.notify('TEAM', 'ONE', 'A', 'banana')
+    outbox.notify('TEAM', 'ONE', 'B', 'banana', 3)
+    outbox.notify('TEAM', 'ONE', 'A', 'banana')
+    outbox.notify('TEAM', 'TWO', 'A', 'banana')
+
+    assert sent == []
+
+    outbox.flush_notifications()
+
+    assert sent == [
+        ('TEAM', 'ONE', 'You received 5 :banana: from <@A>, <@B>!'),
+        ('TEAM', 'TWO', 'You received a :banana: from <@A>!'),
+    ]
+
+    outbox.flush_notifications()
+
+    assert len(sent) == 2
+
+def test_notifications_are_sent_immediately_without_window(monkeypatch):
+    sent = []
+
+    monkeypatch.setattr(outbox, 'post_message', lambda team_id, text, channel: sent.append(text))
+
+    outbox.notify('TEAM', 'ONE', 'A', 'banana', 2)
+
+    assert sent == ['You received 2 :banana: from <@A>!']
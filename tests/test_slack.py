@@ -0,0 +1,171 @@
+import os
+import pytest
+import time
+
+import mrtallyman.db as db
+import mrtallyman.slack as slack
+
+def test_duplicate_events_are_detected(monkeypatch):
+    claimed = set()
+
+    def claim_event(event_id):
+        if event_id in claimed:
+            return False
+        claimed.add(event_id)
+        return True
+
+    monkeypatch.setattr(db, 'claim_event', claim_event)
+    monkeypatch.setattr(db, 'purge_events', lambda max_age: 0)
+    monkeypatch.setattr(slack, '_seen_events', slack.OrderedDict())
+
+    assert not slack.is_duplicate_event({'event_id': 'EV1'})
+    assert slack.is_duplicate_event({'event_id': 'EV1'})
+    assert not slack.is_duplicate_event({'event_id': 'EV2'})
+    assert not slack.is_duplicate_event({})
+
+def test_duplicates_from_other_processes_are_detected(monkeypatch):
+    monkeypatch.setattr(db, 'claim_event', lambda event_id: False)
+    monkeypatch.setattr(db, 'purge_events', lambda max_age: 0)
+    monkeypatch.setattr(slack, '_seen_events', slack.OrderedDict())
+
+    assert slack.is_duplicate_event({'event_id': 'EV1'})
+
+def test_seen_events_are_bounded(monkeypatch):
+    monkeypatch.setenv('EVENT_DEDUP_SIZE', '2')
+    monkeypatch.setattr(db, 'claim_event', lambda event_id: True)
+    monkeypatch.setattr(db, 'purge_events', lambda max_age: 0)
+    monkeypatch.setattr(slack, '_seen_events', slack.OrderedDict())
+
+    for event_id in ['EV1', 'EV2', 'EV3']:
+        slack.is_duplicate_event({'event_id': event_id})
+
+    assert list(slack._seen_events) == ['EV2', 'EV3']
+
+def test_expired_events_are_purged_off_the_request(monkeypatch):
+    import threading
+
+    threads = []
+    purged = threading.Event()
+
+    def purge_events(max_age):
+        threads.append(threading.current_thread().name)
+        purged.set()
+
+    monkeypatch.setattr(db, 'claim_event', lambda event_id: True)
+    monkeypatch.setattr(db, 'purge_events', purge_events)
+    monkeypatch.setattr(slack, '_seen_events', slack.OrderedDict())
+    monkeypatch.setattr(slack, '_last_purge', 0)
+
+    assert not slack.is_duplicate_event({'event_id': 'EV1'})
+    assert purged.wait(1)
+    assert threads == ['purge-events']
+
+def test_failed_events_give_up_their_claim(monkeypatch):
+    claimed = set()
+
+    def claim_event(event_id):
+        if event_id in claimed:
+            return False
+        claimed.add(event_id)
+        return True
+
+    monkeypatch.delenv('EVENT_QUEUE', raising=False)
+    monkeypatch.setattr(db, 'claim_event', claim_event)
+    monkeypatch.setattr(db, 'unclaim_event', claimed.discard)
+    monkeypatch.setattr(db, 'purge_events', lambda max_age: 0)
+    monkeypatch.setattr(slack, '_seen_events', slack.OrderedDict())
+
+    def handler(payload):
+        raise RuntimeError('down')
+
+    monkeypatch.setitem(slack.handlers, 'test_event', [handler])
+    payload = {'event_id': 'EV1', 'event': {'type': 'test_event'}}
+
+    funcs = slack.accept_event(payload)
+    with pytest.raises(RuntimeError):
+        slack.dispatch_event(payload, funcs)
+
+    assert claimed == set()
+    assert slack.accept_event(payload) == [handler]
+
+def test_purge_events_deletes_until_none_are_left(connections):
+    with db.db_cursor():
+        pass
+    connections[0].results.extend([{'seen_at': 1.0}, {'seen_at': 2.0}, None])
+    connections[0].rowcounts.extend([0, 2, 0, 2, 0, 1])
+
+    assert db.purge_events(3600, limit=2) == 5
+
+    deletes = [sql for sql, args in connections[0].executed if sql.startswith('DELETE')]
+    assert len(deletes) == 3
+    assert not any('LIMIT' in sql for sql in deletes)
+
+def test_filtered_events_are_not_claimed_or_queued(monkeypatch):
+    claimed = []
+    queued = []
+    handled = []
+
+    def handler(payload):
+        handled.append(payload)
+
+    def claim_event(event_id):
+        claimed.append(event_id)
+        return True
+
+    monkeypatch.setenv('EVENT_QUEUE', '1')
+    monkeypatch.setitem(slack.handlers, 'test_event', [handler])
+    monkeypatch.setitem(slack.conditions, (handler.__module__, handler.__name__), lambda payload: payload['event'].get('text') == 'yes')
+    monkeypatch.setattr(db, 'claim_event', claim_event)
+    monkeypatch.setattr(db, 'purge_events', lambda max_age: 0)
+    monkeypatch.setattr(db, 'enqueue_job', queued.append)
+    monkeypatch.setattr(slack, '_seen_events', slack.OrderedDict())
+
+    assert slack.accept_event({'event_id': 'EV1', 'event': {'type': 'test_event', 'text': 'no'}}) == []
+    assert slack.handle_event({'event': {'type': 'test_event', 'text': 'no'}})
+    assert claimed == [] and handled == []
+
+    payload = {'event_id': 'EV2', 'event': {'type': 'test_event', 'text': 'yes'}}
+    slack.dispatch_event(payload, slack.accept_event(payload))
+    assert claimed == ['EV2'] and queued == [payload]
+
+def test_plain_chatter_issues_no_queries(monkeypatch, connections):
+    import json
+    import mrtallyman
+
+    class Request:
+        def __init__(self, body):
+            self.body = body.encode('utf-8')
+            timestamp = str(time.time())
+            self.headers = {
+                'X-Slack-Request-Timestamp': timestamp,
+                'X-Slack-Signature': slack.generate_signature(timestamp, os.environ['SLACK_SIGNING_SECRET'], self.body),
+            }
+
+        def get_data(self):
+            return self.body
+
+    def handler(payload):
+        raise AssertionError('chatter was dispatched')
+
+    team = {'reward_emojis': 'banana', 'troll_emojis': 'troll'}
+    monkeypatch.setattr(mrtallyman, 'get_team_config', lambda team_id: team)
+    monkeypatch.setitem(slack.handlers, 'message', [handler])
+    monkeypatch.setitem(slack.conditions, (handler.__module__, handler.__name__), mrtallyman.wants_message)
+    event = {'type': 'message', 'channel_type': 'channel', 'channel': 'C1', 'user': 'U1', 'text': 'just chatting :smile:'}
+    body = json.dumps({'type': 'event_callback', 'team_id': 'TEAM', 'event_id': 'EV1', 'event': event})
+
+    assert slack.handle_request(None, Request(body)) is True
+    assert connections == []
+
+def test_generate_signature_accepts_str_and_bytes():
+    # Known signature from the Slack request signing documentation.
+    body = 'token=xyzz0WbapA4vBCDEFasx0q6G&team_id=T1DC2JH3J&team_domain=testteamnow&channel_id=G8PSS9T3V&channel_name=foobar&user_id=U2CERLKJA&user_name=roadrunner&command=%2Fwebhook-collect&text=&response_url=https%3A%2F%2Fhooks.slack.com%2Fcommands%2FT1DC2JH3J%2F397700885554%2F96rGlfmibIGlgcZRskXaIFfN&trigger_id=398738663015.47445629121.803a0bc887a14d10d2c447fce8b6703c'
+    secret = '8f742231b10e8888abcd99yyyzzz85a5'
+    expected = 'v0=a2114d57b48eac39b9ad189dd8316235a7b4a8d21a10bd27519666489c69b503'
+
+    assert slack.generate_signature('1531420618', secret, body) == expected
+    assert slack.generate_signature('1531420618', secret, body.encode('utf-8')) == expected
+
+def test_valid_signature_rejects_bad_timestamps():
+    assert not slack.valid_signature('not-a-number', 'v0=', b'{}')
+    assert not slack.valid_signature('1531420618', 'v0=', b'{}')
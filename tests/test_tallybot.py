@@ -2,8 +2,7 @@ import json
 import os
 import time
 
-from mrtallyman.db import (delete_team_table,
-                    get_table_name,
+from mrtallyman.db import (delete_team_users,
                     get_team_user)
 from mrtallyman.slack import generate_signature
 from urllib.parse import parse_qsl, urlencode
@@ -666,12 +665,20 @@ def test_cli_init_db(app):
     result = runner.invoke(init_db_command)
     assert 'Initialized the database\n' == result.output
 
-def test_delete_missing_table(requests_mock, app):
+def test_delete_missing_team_users(requests_mock, app):
     post_message = requests_mock.post('https://slack.com/api/chat.postMessage', json={'ok': True})
-    delete_team_table('UNKNOWN', 'CHANNEL')
+    delete_team_users('UNKNOWN', 'CHANNEL')
     assert post_message.called
-    table_name = get_table_name('UNKNOWN')
     assert post_message.last_request.body == urlencode({
         'channel': 'CHANNEL',
-        'text': 'Table %s is not there' % table_name,
+        'text': 'Team UNKNOWN has no users',
     })
+
+def test_parse_leaderboard_command():
+    from mrtallyman import parse_leaderboard_command
+
+    assert parse_leaderboard_command('tally') == 'all'
+    assert parse_leaderboard_command('leaderboard week') == 'week'
+    assert parse_leaderboard_command('bananas month') == 'month'
+    assert parse_leaderboard_command('tally me') is None
+    assert parse_leaderboard_command(None) is None
@@ -0,0 +1,60 @@
+import mrtallyman.db as db
+import mrtallyman.utilities as utilities
+
+def test_get_users_info_uses_shared_cache(monkeypatch):
+    saved = {}
+    fetched = []
+
+    def fetch_user_info(team_id, user_id):
+        fetched.append(user_id)
+        return {'user': {'id': user_id}}
+
+    monkeypatch.setenv('USER_CACHE_TTL', '60')
+    monkeypatch.setattr(db, 'get_user_profiles', lambda team_id, user_ids, max_age: {'CACHED': {'user': {'id': 'CACHED'}}})
+    monkeypatch.setattr(db, 'save_user_profiles', lambda team_id, infos: saved.update(infos))
+    monkeypatch.setattr(utilities, 'fetch_user_info', fetch_user_info)
+
+    infos = utilities.get_users_info('TEAM', ['CACHED', 'ONE', 'TWO', 'ONE'])
+
+    assert sorted(infos.keys()) == ['CACHED', 'ONE', 'TWO']
+    assert sorted(fetched) == ['ONE', 'TWO']
+    assert sorted(saved.keys()) == ['ONE', 'TWO']
+
+def test_match_message_counts_emojis_and_mentions():
+    team = {'reward_emojis': 'banana,+1', 'troll_emojis': 'troll,trollface'}
+
+    found = utilities.match_message(team, '<@ONE> <@TWO> you deserve 2! :banana: :banana: :+1: :trollface:')
+
+    assert found == {'mentions': ['ONE', 'TWO'], 'rewards': 3, 'trolls': 1}
+
+def test_match_message_without_troll_emojis():
+    team = {'reward_emojis': 'banana', 'troll_emojis': ''}
+
+    found = utilities.match_message(team, '<@ONE> :troll: ::')
+
+    assert found == {'mentions': ['ONE'], 'rewards': 0, 'trolls': 0}
+
+def test_get_team_day_falls_back_to_utc():
+    from datetime import datetime, timezone
+
+    assert utilities.get_team_day({'timezone': 'Nowhere/Special'}) == datetime.now(timezone.utc).date()
+    assert utilities.get_team_day({'timezone': None}) == datetime.now(timezone.utc).date()
+
+def test_is_scoring_message():
+    team = {'reward_emojis': 'banana', 'troll_emojis': 'troll'}
+
+    assert not utilities.is_scoring_message(team, 'just chatting')
+    assert not utilities.is_scoring_message(team, 'time is 10:30 :smile:')
+    assert not utilities.is_scoring_message(team, 'have a :banana:')
+    assert utilities.is_scoring_message(team, '<@ONE> have a :banana:')
+    assert utilities.is_scoring_message(team, 'what a :troll:')
+    assert not utilities.is_scoring_message(None, '<@ONE> have a :banana:')
+
+def test_is_scoring_reaction():
+    team = {'reward_emojis': 'banana', 'troll_emojis': 'troll'}
+
+    assert utilities.is_scoring_reaction(team, {'reaction': 'banana', 'user': 'ONE', 'item_user': 'TWO'})
+    assert utilities.is_scoring_reaction(team, {'reaction': 'troll', 'user': 'ONE', 'item_user': 'TWO'})
+    assert not utilities.is_scoring_reaction(team, {'reaction': 'smile', 'user': 'ONE', 'item_user': 'TWO'})
+    assert not utilities.is_scoring_reaction(team, {'reaction': 'banana', 'user': 'ONE', 'item_user': 'ONE'})
+    assert not utilities.is_scoring_reaction(team, {'reaction': 'banana', 'user': 'ONE'})
@@ -0,0 +1,23 @@
+import mrtallyman.worker as worker
+
+def test_process_job_completes(monkeypatch):
+    completed = []
+    monkeypatch.setattr(worker, 'handle_event', lambda payload: True)
+    monkeypatch.setattr(worker, 'complete_job', completed.append)
+
+    worker.process_job({'id': 1, 'attempts': 1, 'payload': {}}, 5)
+
+    assert completed == [1]
+
+def test_process_job_fails(monkeypatch):
+    failed = []
+
+    def handle_event(payload):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(worker, 'handle_event', handle_event)
+    monkeypatch.setattr(worker, 'fail_job', lambda job, error, max_attempts: failed.append((job['id'], max_attempts, 'boom' in error)))
+
+    worker.process_job({'id': 1, 'attempts': 1, 'payload': {}}, 5)
+
+    assert failed == [(1, 5, True)]